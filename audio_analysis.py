@@ -0,0 +1,366 @@
+import os
+import json
+import logging
+from time import perf_counter
+import numpy as np
+
+# install Nebula modules
+from nebula.nebula_dataclass import MAX_CHANNELS
+
+# features of each chunk, in FeatureExtractor.features row order
+FEATURES = ('rms', 'centroid', 'band_low', 'band_mid', 'band_high', 'onset', 'tempo')
+
+
+class FeatureExtractor:
+    """Streaming analysis of mic chunks, one vectorised pass per chunk
+    over all channels. The window, band weights and working buffers are
+    made once, and every step writes into them, so a chunk only allocates
+    the rFFT output (and the tempo estimate, every tempo_every chunks).
+
+    Features per channel (see FEATURES):
+        rms: root mean square level, 0.0 - 1.0 of full scale
+        centroid: spectral centroid, 0.0 - 1.0 of the Nyquist frequency
+        band_low, band_mid, band_high: share of the spectral energy below
+            low_cut Hz, between low_cut and high_cut Hz, and above high_cut Hz
+        onset: onset strength, the rise in the spectrum since the last
+            chunk relative to its total (half-wave rectified spectral flux)
+        tempo: beats per minute, from the autocorrelation of the recent
+            onset strengths (0 until there is enough history)
+
+    Args:
+        rate: sample rate in Hz
+        chunk: frames per chunk
+        channels: number of channels per chunk
+        low_cut: top of the low band in Hz
+        high_cut: bottom of the high band in Hz
+        tempo_seconds: length of onset history for the tempo estimate
+        tempo_every: chunks between tempo estimates
+        tempo_range: (min, max) beats per minute to look for"""
+
+    def __init__(self, rate: int = 44100, chunk: int = 2 ** 11, channels: int = 1,
+                 low_cut: float = 250, high_cut: float = 2000,
+                 tempo_seconds: float = 8, tempo_every: int = 8,
+                 tempo_range: tuple = (60, 200)):
+        self.rate = rate
+        self.chunk = chunk
+        self.channels = channels
+
+        # analysis buffers
+        self.window = np.hanning(chunk).astype(np.float32)[:, np.newaxis]
+        self.samples = np.zeros((chunk, channels), dtype=np.float32)
+        bins = chunk // 2 + 1
+        self.magnitude = np.zeros((bins, channels), dtype=np.float32)
+        self.last_magnitude = np.zeros((bins, channels), dtype=np.float32)
+        self.flux = np.zeros((bins, channels), dtype=np.float32)
+        self.power = np.zeros((bins, channels), dtype=np.float32)
+        self.weighted = np.zeros((bins, channels), dtype=np.float32)
+        self.total = np.zeros(channels, dtype=np.float32)
+        self.band_total = np.zeros(channels, dtype=np.float32)
+        self.features = np.zeros((len(FEATURES), channels), dtype=np.float32)
+
+        # normalised frequency of each bin, and which band it is in
+        frequencies = np.fft.rfftfreq(chunk, 1 / rate)
+        self.bin_position = (frequencies / (rate / 2)).astype(np.float32)[:, np.newaxis]
+        self.band_weights = np.stack([frequencies < low_cut,
+                                      (frequencies >= low_cut) & (frequencies < high_cut),
+                                      frequencies >= high_cut]).astype(np.float32)
+
+        # onset history for the tempo estimate
+        self.chunk_period = chunk / rate
+        self.onset_history = np.zeros((int(tempo_seconds / self.chunk_period), channels), dtype=np.float32)
+        self.tempo_every = tempo_every
+        self.min_lag = max(1, int(np.ceil(60 / tempo_range[1] / self.chunk_period)))
+        self.max_lag = min(len(self.onset_history) // 2, int(60 / tempo_range[0] / self.chunk_period))
+        self.chunks = 0
+        self.index = {name: row for row, name in enumerate(FEATURES)}
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        """Analyses one chunk.
+        Args:
+            block: int16 array of shape (chunk, channels)
+        Returns:
+            array of shape (len(FEATURES), channels). NB this is a reused buffer"""
+        features = self.features
+        samples = self.samples
+        np.multiply(block, 1 / 32768, out=samples)
+
+        # level
+        rms = features[self.index['rms']]
+        np.einsum('ij,ij->j', samples, samples, out=rms)
+        rms /= self.chunk
+        np.sqrt(rms, out=rms)
+
+        # spectrum
+        samples *= self.window
+        np.abs(np.fft.rfft(samples, axis=0), out=self.magnitude)
+        total = self.total
+        np.sum(self.magnitude, axis=0, out=total)
+        np.maximum(total, 1e-12, out=total)
+
+        centroid = features[self.index['centroid']]
+        np.multiply(self.bin_position, self.magnitude, out=self.weighted)
+        np.sum(self.weighted, axis=0, out=centroid)
+        centroid /= total
+
+        bands = features[self.index['band_low']:self.index['band_high'] + 1]
+        np.multiply(self.magnitude, self.magnitude, out=self.power)
+        np.matmul(self.band_weights, self.power, out=bands)
+        np.sum(bands, axis=0, out=self.band_total)
+        np.maximum(self.band_total, 1e-12, out=self.band_total)
+        bands /= self.band_total
+
+        # onset strength: how much the spectrum rose since the last chunk
+        onset = features[self.index['onset']]
+        np.subtract(self.magnitude, self.last_magnitude, out=self.flux)
+        np.maximum(self.flux, 0, out=self.flux)
+        np.sum(self.flux, axis=0, out=onset)
+        onset /= total
+        self.last_magnitude, self.magnitude = self.magnitude, self.last_magnitude
+
+        # tempo, every few chunks
+        self.onset_history[self.chunks % len(self.onset_history)] = features[self.index['onset']]
+        self.chunks += 1
+        if self.chunks >= len(self.onset_history) and self.chunks % self.tempo_every == 0:
+            features[self.index['tempo']] = self.estimate_tempo()
+        return features
+
+    def estimate_tempo(self) -> np.ndarray:
+        """Beats per minute of each channel, from the autocorrelation of its onset history"""
+        envelope = self.onset_history - self.onset_history.mean(axis=0)
+        n = len(envelope)
+        spectrum = np.fft.rfft(envelope, 2 * n, axis=0)
+        autocorrelation = np.fft.irfft(spectrum * spectrum.conj(), axis=0)[:n]
+
+        lags = autocorrelation[self.min_lag:self.max_lag + 1]
+        best = np.argmax(lags, axis=0)
+        channels = np.arange(self.channels)
+
+        # parabolic interpolation around the peak, for a finer lag
+        below = lags[np.maximum(best - 1, 0), channels]
+        peak = lags[best, channels]
+        above = lags[np.minimum(best + 1, len(lags) - 1), channels]
+        curve = below - 2 * peak + above
+        offset = np.where(curve < 0, 0.5 * (below - above) / np.where(curve < 0, curve, 1), 0)
+
+        lag = (best + self.min_lag + offset) * self.chunk_period
+        return np.where(peak > 0, 60 / lag, 0)
+
+    def to_dict(self, channel: int = None) -> dict:
+        """Features of one channel, or the mean of all channels, as datadict fields"""
+        if channel is None:
+            values = self.features.mean(axis=1)
+        else:
+            values = self.features[:, channel]
+        return {name: float(value) for name, value in zip(FEATURES, values)}
+
+
+class AdaptiveNormaliser:
+    """Streaming normalisation of a percept (e.g. mic amplitude) to 0.0 - 1.0
+    against the room it is in, rather than fixed constants. Tracks a low
+    and a high quantile of the input per channel with stochastic quantile
+    estimates: each chunk nudges them up or down by a step proportional
+    to the current range, so memory and time per chunk are constant, and
+    old chunks decay away exponentially. Inputs at or below the low
+    quantile map to 0.0, at or above the high quantile to 1.0.
+
+    The calibration (both quantiles) can be saved, and loaded at the next
+    piece in the same venue, which then skips the warm up.
+
+    Args:
+        channels: number of channels normalised per update
+        low_quantile: input quantile that maps to 0.0
+        high_quantile: input quantile that maps to 1.0
+        decay: step rate once warmed up, about 1 / number of chunks remembered
+        min_range: smallest high - low range, so silence does not blow up noise
+        initial: optional (low, high) calibration to start the quantiles
+            from, e.g. a known room. Default (and no loaded calibration)
+            starts them at the first input, min_range apart
+        warm_up: number of chunks of faster (1 / count) steps at the start"""
+
+    def __init__(self, channels: int = 1,
+                 low_quantile: float = 0.05, high_quantile: float = 0.95,
+                 decay: float = 0.02, min_range: float = 500,
+                 initial: tuple = None, warm_up: int = 200):
+        self.low_quantile = low_quantile
+        self.high_quantile = high_quantile
+        self.decay = decay
+        self.min_range = min_range
+        self.warm_up = warm_up
+        self.count = 0
+
+        self.low = np.zeros(channels, dtype=np.float64)
+        self.high = np.full(channels, min_range, dtype=np.float64)
+        self.seeded = initial is not None
+        if self.seeded:
+            self.low[:] = initial[0]
+            self.high[:] = initial[1]
+
+        # working buffers, so an update allocates nothing
+        self.step = np.zeros(channels, dtype=np.float64)
+        self.below = np.zeros(channels, dtype=bool)
+        self.delta = np.zeros(channels, dtype=np.float64)
+        self.value = np.zeros(channels, dtype=np.float64)
+
+    def update(self, x) -> np.ndarray:
+        """Adds one input per channel to the calibration and normalises it.
+        Returns:
+            array of shape (channels,) in 0.0 - 1.0. NB this is a reused buffer"""
+        self.count += 1
+        if self.count == 1 and not self.seeded:
+            # NB - upward steps are much bigger than downward ones for the high
+            # quantile, so start at the input rather than far above it
+            self.low[:] = x
+            np.add(self.low, self.min_range, out=self.high)
+        rate = max(self.decay, 1 / self.count) if self.count < self.warm_up else self.decay
+
+        # step in proportion to the current range
+        np.subtract(self.high, self.low, out=self.step)
+        np.maximum(self.step, self.min_range, out=self.step)
+        self.step *= rate
+
+        for estimate, quantile in ((self.low, self.low_quantile), (self.high, self.high_quantile)):
+            np.less(x, estimate, out=self.below)
+            np.subtract(quantile, self.below, out=self.delta)
+            self.delta *= self.step
+            estimate += self.delta
+
+        # keep the quantiles at least min_range apart
+        np.add(self.low, self.min_range, out=self.delta)
+        np.maximum(self.high, self.delta, out=self.high)
+
+        np.subtract(x, self.low, out=self.value)
+        np.subtract(self.high, self.low, out=self.delta)
+        self.value /= self.delta
+        np.clip(self.value, 0, 1, out=self.value)
+        return self.value
+
+    def calibration(self) -> dict:
+        """Current calibration of the normaliser"""
+        return {'low': self.low.tolist(),
+                'high': self.high.tolist(),
+                'count': self.count,
+                'low_quantile': self.low_quantile,
+                'high_quantile': self.high_quantile}
+
+    def save(self, path: str):
+        """Saves the calibration, e.g. at the end of a piece"""
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as calibration_file:
+            json.dump(self.calibration(), calibration_file, indent=2)
+        logging.info(f'saved percept calibration to {path}: {self.calibration()}')
+
+    def load(self, path: str) -> bool:
+        """Loads a saved calibration, if there is one for the same channels.
+        Returns:
+            True if it was loaded"""
+        if not os.path.exists(path):
+            return False
+        with open(path) as calibration_file:
+            calibration = json.load(calibration_file)
+        if len(calibration['low']) != len(self.low):
+            logging.warning(f'percept calibration {path} is for {len(calibration["low"])} channels, not using it')
+            return False
+        self.low[:] = calibration['low']
+        self.high[:] = calibration['high']
+        self.count = max(self.count, self.warm_up)
+        self.seeded = True
+        logging.info(f'loaded percept calibration from {path}: {calibration}')
+        return True
+
+
+class PerceptStage:
+    """Turns each mic chunk into Nebula percepts, in one vectorised pass
+    over all channels, and publishes them to the datadict in one update:
+        user_in: normalised level of the loudest channel
+        channel_in, channel_rms, channel_centroid, channel_onset: per channel
+        rms, centroid, band_low, band_mid, band_high, onset, tempo:
+            features averaged over the channels
+
+    Args:
+        datadict: the shared Nebula dataclass
+        rate: sample rate in Hz
+        chunk: frames per chunk
+        channels: number of channels per chunk
+        calibration_path: optional .json file of the normaliser calibration"""
+
+    def __init__(self, datadict, rate: int = 44100, chunk: int = 2 ** 11, channels: int = 1,
+                 calibration_path: str = None):
+        self.datadict = datadict
+        self.channels = channels
+        self.published = min(channels, MAX_CHANNELS)
+        self.calibration_path = calibration_path
+        if channels > MAX_CHANNELS:
+            logging.warning(f'only the first {MAX_CHANNELS} of {channels} mic channels get their own fields')
+
+        # preallocated, so the level pass allocates nothing
+        self.block = np.zeros((chunk, channels), dtype=np.int16)
+        self.magnitude = np.zeros((chunk, channels), dtype=np.float32)
+        self.peaks = np.zeros(channels, dtype=np.float32)
+
+        self.analysis = FeatureExtractor(rate=rate, chunk=chunk, channels=channels)
+
+        # mic level is normalised against the room, not fixed constants
+        self.normaliser = AdaptiveNormaliser(channels=channels)
+        if calibration_path:
+            self.normaliser.load(calibration_path)
+
+    def process(self, block: np.ndarray = None):
+        """Analyses and publishes one chunk.
+        Args:
+            block: int16 array of shape (chunk, channels), default is self.block"""
+        if block is None:
+            block = self.block
+
+        # get amplitude of each channel
+        # NB - cast before abs, as abs(-32768) overflows int16
+        np.copyto(self.magnitude, block)
+        np.abs(self.magnitude, out=self.magnitude)
+        np.mean(self.magnitude, axis=0, out=self.peaks)
+        self.peaks *= 2
+
+        peak = self.peaks.max()
+        if peak > 2000:
+            bars = "#" * int(50 * peak / 2 ** 16)
+            logging.debug("MIC LISTENER: %05d %s" % (peak, bars))
+
+        # normalise it for range 0.0 - 1.0, against the recent levels in the room
+        levels = self.normaliser.update(self.peaks)
+
+        # analyse the rest of the percept features
+        features = self.analysis.process(block)
+        index = self.analysis.index
+        published = self.published
+
+        # put normalised amplitude and features into Nebula's dictionary for use,
+        # as one update
+        self.datadict.update(user_in=float(levels.max()),
+                             channel_in=levels[:published],
+                             channel_rms=features[index['rms'], :published],
+                             channel_centroid=features[index['centroid'], :published],
+                             channel_onset=features[index['onset'], :published],
+                             **self.analysis.to_dict())
+
+    def save_calibration(self):
+        if self.calibration_path:
+            self.normaliser.save(self.calibration_path)
+
+
+if __name__ == "__main__":
+    # benchmark on noise with a click every 0.5 seconds (120 bpm)
+    extractor = FeatureExtractor()
+    test_rate, test_chunk = extractor.rate, extractor.chunk
+    n_chunks = 400
+    signal = np.random.normal(0, 300, n_chunks * test_chunk)
+    beat = int(0.5 * test_rate)
+    for start in range(0, len(signal), beat):
+        signal[start:start + 400] += np.random.normal(0, 12000, len(signal[start:start + 400]))
+    blocks = np.clip(signal, -32768, 32767).astype(np.int16).reshape(n_chunks, test_chunk, 1)
+
+    times = []
+    for test_block in blocks:
+        start_time = perf_counter()
+        extractor.process(test_block)
+        times.append(perf_counter() - start_time)
+    print(f'per chunk: mean {1000 * np.mean(times):.3f} ms, max {1000 * np.max(times):.3f} ms '
+          f'(chunk period {1000 * extractor.chunk_period:.1f} ms)')
+    print(extractor.to_dict())
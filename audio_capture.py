@@ -0,0 +1,238 @@
+from threading import Event
+from time import monotonic
+import logging
+import numpy as np
+
+
+class AudioRing:
+    """Preallocated ring buffer of audio frames, for one writer
+    (the audio callback) and one reader (the listener thread).
+    Each side only moves its own counter, so neither takes a lock.
+    If the reader falls more than the whole ring behind, the frames
+    it missed are skipped and counted as dropped.
+
+    Args:
+        frames: capacity of the ring in frames
+        channels: number of interleaved channels per frame
+        dtype: sample format"""
+
+    def __init__(self, frames: int, channels: int = 1, dtype=np.int16):
+        self.capacity = frames
+        self.buffer = np.zeros((frames, channels), dtype=dtype)
+        self.written = 0
+        self.read_count = 0
+        self.dropped = 0
+        self.ready = Event()
+
+    def available(self) -> int:
+        return self.written - self.read_count
+
+    def write(self, frames: np.ndarray):
+        """Copies frames (n, channels) into the ring. NB - writer side only"""
+        n = len(frames)
+        start = self.written % self.capacity
+        first = min(n, self.capacity - start)
+        self.buffer[start:start + first] = frames[:first]
+        self.buffer[:n - first] = frames[first:]
+        self.written += n
+        self.ready.set()
+
+    def read_into(self, out: np.ndarray) -> bool:
+        """Copies the next len(out) frames into out. NB - reader side only
+        Returns:
+            False if there are not enough frames yet"""
+        n = len(out)
+        behind = self.available() - self.capacity
+        if behind > 0:
+            self.dropped += behind
+            self.read_count += behind
+        if self.available() < n:
+            return False
+
+        start = self.read_count % self.capacity
+        first = min(n, self.capacity - start)
+        out[:first] = self.buffer[start:start + first]
+        out[first:] = self.buffer[:n - first]
+
+        # the writer lapped us while copying, so out is torn
+        lapped = self.available() - self.capacity
+        if lapped > 0:
+            self.dropped += lapped + n
+            self.read_count += lapped + n
+            return False
+        self.read_count += n
+        return True
+
+    def skip(self, n: int):
+        """Drops the next n frames unread. NB - reader side only"""
+        self.dropped += n
+        self.read_count += n
+
+    def wait(self, n: int, timeout: float = None) -> bool:
+        """Waits until n frames are available to read"""
+        while self.available() < n:
+            self.ready.clear()
+            if self.available() >= n:
+                break
+            if not self.ready.wait(timeout):
+                return False
+        return True
+
+
+class AudioCapture:
+    """Mic input in PyAudio callback mode. PortAudio calls back with
+    each chunk on its own thread, which only copies it into a
+    preallocated ring. Analysis reads from the ring at its own pace,
+    into its own preallocated block, so capture never waits on it.
+
+    Dropped frames are counted both from PortAudio input overflows,
+    and from the reader falling more than the whole ring behind.
+
+    Args:
+        rate: sample rate in Hz
+        chunk: frames per callback
+        channels: number of channels to open
+        device: PyAudio input device index, None = default input
+        ring_chunks: ring capacity in chunks"""
+
+    def __init__(self, rate: int = 44100, chunk: int = 2 ** 11, channels: int = 1,
+                 device: int = None, ring_chunks: int = 16):
+        self.rate = rate
+        self.chunk = chunk
+        self.channels = channels
+        self.device = device
+        self.ring = AudioRing(chunk * ring_chunks, channels)
+        self.overflows = 0
+        self.callbacks = 0
+        self.audio = None
+        self.stream = None
+
+    def open(self):
+        """Opens the stream without starting it, so the device is checked
+        early, but the ring only fills once the reader is ready for it"""
+        import pyaudio
+
+        self.input_overflow = pyaudio.paInputOverflow
+        self.continue_flag = pyaudio.paContinue
+        self.audio = pyaudio.PyAudio()
+        self.stream = self.audio.open(format=pyaudio.paInt16,
+                                      channels=self.channels,
+                                      rate=self.rate,
+                                      input=True,
+                                      input_device_index=self.device,
+                                      frames_per_buffer=self.chunk,
+                                      stream_callback=self.callback,
+                                      start=False)
+
+    def start(self):
+        """Starts the stream, opening it first if need be"""
+        if self.stream is None:
+            self.open()
+        self.stream.start_stream()
+
+    def callback(self, in_data, frame_count, time_info, status):
+        # NB - runs on the PortAudio thread, so keep it to a copy
+        if status & self.input_overflow:
+            self.overflows += 1
+        self.callbacks += 1
+        self.ring.write(np.frombuffer(in_data, dtype=np.int16).reshape(frame_count, self.channels))
+        return None, self.continue_flag
+
+    def read(self, out: np.ndarray, timeout: float = 1.0) -> bool:
+        """Fills out (frames, channels) with the next frames, waiting up to timeout.
+        Returns:
+            False if no full block arrived in time"""
+        if not self.ring.wait(len(out), timeout):
+            return False
+        return self.ring.read_into(out)
+
+    @property
+    def dropped_frames(self) -> int:
+        """Frames lost, to PortAudio overflows (one chunk each) or a slow reader"""
+        return self.overflows * self.chunk + self.ring.dropped
+
+    def stop(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.audio.terminate()
+            self.stream = None
+        logging.info(f'audio capture: {self.callbacks} chunks, {self.overflows} input overflows, '
+                     f'{self.dropped_frames} dropped frames')
+
+
+class MultiDeviceCapture:
+    """Several capture devices read as one multichannel input.
+    Each device keeps its own callback and ring, and a read fills its
+    columns of the combined (frames, channels) block in device order.
+
+    A read waits until every device has the frames before reading any,
+    and a device that drops frames has the others drop the same frames,
+    so the devices always read the same moments in time.
+
+    Args:
+        captures: list of AudioCapture, one per device"""
+
+    def __init__(self, captures: list):
+        self.captures = captures
+        self.rate = captures[0].rate
+        self.chunk = captures[0].chunk
+        self.channels = sum(capture.channels for capture in captures)
+        self.columns = []
+        first = 0
+        for capture in captures:
+            self.columns.append(slice(first, first + capture.channels))
+            first += capture.channels
+
+    def open(self):
+        for capture in self.captures:
+            capture.open()
+
+    def start(self):
+        for capture in self.captures:
+            capture.start()
+
+    def read(self, out: np.ndarray, timeout: float = 1.0) -> bool:
+        """Fills out (frames, channels) with the next frames of every device
+        Returns:
+            False if a device had no full block in time, or dropped frames"""
+        deadline = monotonic() + timeout
+        for capture in self.captures:
+            if not capture.ring.wait(len(out), max(0.0, deadline - monotonic())):
+                return False
+
+        read = all([capture.ring.read_into(out[:, columns])
+                    for capture, columns in zip(self.captures, self.columns)])
+
+        # realign on the device that skipped furthest ahead
+        read_counts = [capture.ring.read_count for capture in self.captures]
+        ahead = max(read_counts)
+        for capture, read_count in zip(self.captures, read_counts):
+            if read_count < ahead:
+                capture.ring.skip(ahead - read_count)
+                read = False
+        return read
+
+    @property
+    def dropped_frames(self) -> int:
+        return sum(capture.dropped_frames for capture in self.captures)
+
+    def stop(self):
+        for capture in self.captures:
+            capture.stop()
+
+
+def open_capture(rate: int, chunk: int, channels: int = 1, devices: list = None):
+    """Builds the mic input: one interleaved device, or several devices.
+    Args:
+        rate: sample rate in Hz
+        chunk: frames per chunk
+        channels: channels to open on each device
+        devices: list of PyAudio input device indexes, None = default input only
+    Returns:
+        AudioCapture or MultiDeviceCapture"""
+    if not devices or len(devices) == 1:
+        return AudioCapture(rate=rate, chunk=chunk, channels=channels,
+                            device=devices[0] if devices else None)
+    return MultiDeviceCapture([AudioCapture(rate=rate, chunk=chunk, channels=channels, device=device)
+                               for device in devices])
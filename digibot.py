@@ -2,11 +2,10 @@
 import sys
 import os
 import struct
-from time import time, sleep
+from time import time, sleep, monotonic
 from serial.tools import list_ports
 from random import randrange, getrandbits, random
 import logging
-from dataclasses import fields
 
 
 # install dobot modules
@@ -18,10 +17,22 @@ from pydobot.enums.CommunicationProtocolIDs import CommunicationProtocolIDs
 
 # install Nebula modules
 from nebula.nebula_dataclass import NebulaDataClass
+from nebula.scheduler import Scheduler
+from dobot_transport import DobotTransport, QueueFlow, queued_index, cp_frames, CP_COMMAND, CP_FRAME
+from gestures import GestureLibrary, squiggle_path, blend_velocity
 
 class Digibot(Dobot):
     """Controls movement and shapes drawn by Dobot.
-    Inherets all the functions of Pydobot, and chances a few"""
+    Inherets all the functions of Pydobot, and chances a few
+
+    Args:
+        pen_prompt: hook called with a message when the pen needs removing
+            or inserting. Default is input(), which waits for enter
+        lookahead: number of commands to keep queued ahead of the arm
+        cp_lookahead: number of CP points to keep queued ahead of the arm
+            while streaming a gesture. Each point is a queued command of
+            only a few ms, so a few tens of them, within the Dobot's own
+            command queue"""
 
     def __init__(self, port,
                  datadict: NebulaDataClass,
@@ -31,7 +42,26 @@ class Digibot(Dobot):
                  speed: int = 5,
                  staves: int = 1,
                  pen: bool = True,
+                 pen_prompt=input,
+                 lookahead: int = 4,
+                 cp_lookahead: int = 32
                  ):
+        # pipelined serial transport, started on the first command
+        self.transport = None
+        self.flow = QueueFlow(self._get_queued_cmd_current_index, lookahead=lookahead)
+        self.cp_lookahead = cp_lookahead
+
+        # predicted pose, from the target of every move issued,
+        # so gestures don't query the real pose before each move
+        self.tracked = None
+        self.resync_period = 10.0
+        self.pose_synced = monotonic()
+        self.next_resync = self.pose_synced + self.resync_period
+        self.pose_queries = 0
+        self.predicted_reads = 0
+        self.moves_since_sync = 0
+        self.last_drift = 0.0
+        self.max_drift = 0.0
         super().__init__(port, verbose)
 
         # set global path
@@ -48,6 +78,10 @@ class Digibot(Dobot):
         self.local_start_time = time()
         # self.end_time = self.start_time + duration_of_piece
         self.pen = pen
+        self.pen_prompt = pen_prompt
+
+        # monotonic deadlines for the daddy/ child/ baby cycles
+        self.scheduler = Scheduler('drawbot')
 
         # calculate the inverse of speed
         # NewValue = (((OldValue - OldMin) * (NewMax - NewMin)) / (OldMax - OldMin)) + NewMin
@@ -68,9 +102,12 @@ class Digibot(Dobot):
 
         print('locating home')
         self.home()
-        input('remove pen, then press enter')
+        self.pen_prompt('remove pen, then press enter')
 
         arm_speed = (((speed - 1) * (300 - 50)) / (10 - 1)) + 50
+        # top velocity of the CP gestures, and the cache of their shapes
+        self.arm_speed = arm_speed
+        self.gestures = GestureLibrary()
         self.speed(velocity=arm_speed,
                    acceleration=arm_speed)
         self.draw_stave(staves=staves)
@@ -86,8 +123,8 @@ class Digibot(Dobot):
     def drawbot_control(self):
         """Listens to the realtime incoming signal that is stored in the dataclass ("user_input")
         and calculates an affectual response based on general boundaries:
-            HIGH - if input stream is LOUD (0.8+) then emit, smash a random fill and break out to Daddy cycle...
-            MEDIUM - if input energy is 0.3-0.8 then emit, a jump out of child loop
+            HIGH - if input stream is LOUD (0.7+) then emit, smash a random fill and break out to Daddy cycle...
+            MEDIUM - if input energy is 0.1-0.7 then emit, a jump out of child loop
             LOW - nothing happens, continues with cycles
         """
 
@@ -100,6 +137,14 @@ class Digibot(Dobot):
                             'affect_net',
                             'self_awareness']
 
+        # wake the baby cycle the moment the mic crosses into HIGH,
+        # rather than at the end of the current rhythm wait
+        loud = self.datadict.subscribe('user_in', threshold=0.7)
+
+        # all cycles below end on absolute deadlines counted from the beat,
+        # so the time spent drawing is taken out of the rhythm
+        self.scheduler.start()
+
         # 1. daddy cycle: top level cycle lasting 6-26 seconds
         while self.running:
             # flag for breaking on big affect signal
@@ -107,13 +152,13 @@ class Digibot(Dobot):
 
             # Top level calc master cycle before a change
             master_cycle = (randrange(600, 2600) / 100) # + self.global_speed
-            loop_end = time() + master_cycle
+            loop_end = self.scheduler.deadline(master_cycle)
 
             logging.debug('\t\t\t\t\t\t\t\t=========AFFECT - Daddy cycle started ===========')
             logging.debug(f"                 interrupt_listener: started! Duration =  {master_cycle} seconds")
 
             # 2. child cycle: waiting for interrupt  from master clock
-            while time() < loop_end:
+            while not self.scheduler.expired(loop_end):
                 # if a major break out then go to Daddy cycle and restart
                 if not self.interrupt_bang:
                     break
@@ -145,16 +190,18 @@ class Digibot(Dobot):
                 logging.info(f'Random stream choice = {self.rnd_stream}')
 
                 # hold this stream for 1-4 secs, unless interrupt bang
-                end_time = time() + (randrange(1000, 4000) / 1000)
+                end_time = self.scheduler.deadline(randrange(1000, 4000) / 1000)
                 logging.debug(f'end time = {end_time}')
 
                 # 3. baby cycle - own time loops
-                while time() < end_time:
+                while not self.scheduler.expired(end_time):
                     logging.debug('\t\t\t\t\t\t\t\t=========Hello - baby cycle 2 ===========')
 
                     # make the master output the current value of the affect stream
                     # 1. go get the current value from dict
-                    thought_train = getattr(self.datadict, self.rnd_stream)
+                    # NB - read with the mic level below from the same datadict version
+                    current = self.datadict.snapshot(self.rnd_stream, 'user_in')
+                    thought_train = current[self.rnd_stream]
                     logging.info(f'Affect stream current input value from {self.rnd_stream} == {thought_train}')
 
                     # 2. send to Master Output
@@ -172,15 +219,22 @@ class Digibot(Dobot):
                     #
                     ###############################################
 
-                    # 1. get current mic level
-                    peak = getattr(self.datadict, "user_in")
+                    # 1. get current mic level,
+                    # or the loudest HIGH crossing since the last cycle
+                    peak = current['user_in']
+                    onsets = loud.poll()
+                    if onsets:
+                        onset = max(onsets, key=lambda event: event.new)
+                        peak = max(peak, onset.new)
+                        logging.info(f'HIGH crossing, reacting {1000 * (monotonic() - onsets[0].time):.0f} ms after it')
                     peak_int = int(peak * 10) + 1
                     logging.info(f'testing current mic level for affect = {peak}, rounded to {peak_int}')
 
                     # 2. calc affect on behaviour
                     # LOUD
                     # if input stream is LOUD then smash a random fill and break out to Daddy cycle...
-                    if peak > 0.7:
+                    # NB - inclusive, as the subscription fires on reaching 0.7
+                    if peak >= 0.7:
                         logging.info('interrupt > HIGH !!!!!!!!!')
 
                         # A - refill dict with random
@@ -192,6 +246,11 @@ class Digibot(Dobot):
                         # C - respond
                         self.high_energy_response()
 
+                        # the response is outside the rhythm, so start a new beat after it,
+                        # and forget crossings that happened during it
+                        self.scheduler.start()
+                        loud.poll()
+
                         # D- break out of this loop, and next (cos of flag)
                         break
 
@@ -212,17 +271,19 @@ class Digibot(Dobot):
 
                         # self.move_y()
 
-                    # and wait for a cycle
-                    sleep(rhythm_rate)
+                    # and wait for a cycle, or a HIGH crossing
+                    self.scheduler.wait(rhythm_rate, wake=loud.fired)
 
+        self.datadict.unsubscribe(loud)
+        self.scheduler.report()
         logging.info('quitting dobot director thread')
 
     # def level_2_cycle(self):
     #
 
     def mid_energy_response(self, peak):
-        (x, y, z, r, j1, j2, j3, j4) = self.pose()
-        logging.debug(f'Current position: x:{x} y:{y} z:{z} j1:{j1} j2:{j2} j3:{j3} j4:{j4}')
+        x, y, z, r = self.tracked_pose()
+        logging.debug(f'Current position: x:{x} y:{y} z:{z}')
 
         """between 2 and 8 make shapes in situ"""
         # randomly choose from the following c hoices
@@ -239,13 +300,7 @@ class Digibot(Dobot):
 
         # 1 = messy squiggles
         if randchoice == 1:
-            squiggle_list = []
-            for n in range(randrange(2, 4)):
-                squiggle_list.append((randrange(-5, 5) / 5,
-                                      randrange(-5, 5) / 5,
-                                      randrange(-5, 5) / 5)
-                                     )
-            self.squiggle(squiggle_list)
+            self.draw_gesture('squiggle', size=randrange(2, 4))
             logging.info('Emission 3-8: small squiggle')
 
         # 2 = dot & line
@@ -288,10 +343,8 @@ class Digibot(Dobot):
     def random_dict_fill(self):
         """Fills the working dataclass with random values. Generally called when
         affect energy is highest"""
-        for field in fields(self.datadict):
-            # print(field.name)
-            rnd = random()
-            setattr(self.datadict, field.name, rnd)
+        # one update, so other threads never see a half filled dict
+        self.datadict.random_fill()
         logging.debug(f'Data dict new random values are = {self.datadict}')
 
     def terminate(self):
@@ -318,10 +371,10 @@ class Digibot(Dobot):
         elapsed = time() - self.local_start_time
 
         # get current y-value
-        (x, y, z, r, j1, j2, j3, j4) = self.pose()
+        x, y, z, r = self.tracked_pose()
         # NewValue = (((OldValue - OldMin) * (NewMax - NewMin)) / (OldMax - OldMin)) + NewMin
         newy = (((elapsed - 0) * (175 - -175)) / (self.duration_of_piece - 0)) + -175
-        logging.debug(f'x:{x} y:{y} z:{z} j1:{j1} j2:{j2} j3:{j3} j4:{j4}')
+        logging.debug(f'x:{x} y:{y} z:{z}')
 
         # check x-axis is in range
         if x <= 200 or x >= 300:
@@ -335,10 +388,11 @@ class Digibot(Dobot):
                 z = 0
 
         # which mode
+        # NB - queued without waiting, the queue flow keeps the arm busy
         if self.continuous_line:
-            self.move_to(x, newy, z, r, True)
+            self.move_to(x, newy, z, r, False)
         else:
-            self.jump_to(x, newy, z, r, True)
+            self.jump_to(x, newy, z, r, False)
 
         logging.info(f'Move Y to x:{round(x)} y:{round(newy)} z:{round(z)}')
 
@@ -348,10 +402,10 @@ class Digibot(Dobot):
         elapsed = time() - self.local_start_time
 
         # get current y-value
-        (x, y, z, r, j1, j2, j3, j4) = self.pose()
+        x, y, z, r = self.tracked_pose()
         # NewValue = (((OldValue - OldMin) * (NewMax - NewMin)) / (OldMax - OldMin)) + NewMin
         newy = ((((elapsed - 0) * (175 - -175)) / (self.duration_of_piece - 0)) + -175) + self.rnd(100)
-        logging.debug(f'x:{x} y:{y} z:{z} j1:{j1} j2:{j2} j3:{j3} j4:{j4}')
+        logging.debug(f'x:{x} y:{y} z:{z}')
 
         # check x-axis is in range
         newx = x + self.rnd(100)
@@ -362,7 +416,7 @@ class Digibot(Dobot):
         # if self.continuous_line:
         #     self.move_to(newx, newy, 0, r, True)
         # else:
-        self.jump_to(newx, newy, 0, r, True)
+        self.jump_to(newx, newy, 0, r, False)
 
     ######################
     # JOYSTICK CONTROLS
@@ -383,7 +437,7 @@ class Digibot(Dobot):
 
         while self.running:
             # get now position
-            [x, y, z, r] = self.pose()[0:4]
+            x, y, z, r = self.tracked_pose()
 
             # read gamepad
             report = gamepad.read(64)
@@ -431,13 +485,8 @@ class Digibot(Dobot):
                 self.high_energy_response()
 
             elif num_buttons == 47:
-                squiggle_list = []
-                for n in range(randrange(2, 4)):
-                    squiggle_list.append((randrange(-10, 10) / 5,
-                                          randrange(-10, 10) / 5,
-                                          randrange(-10, 10) / 5)
-                                         )
-                self.squiggle(squiggle_list)
+                # arcs of up to 2 mm, twice the autonomous squiggles, on the same 0.2 mm grid
+                self.draw_gesture('squiggle', size=randrange(2, 4), span=2)
 
             elif num_buttons == 79:
                 peak = int(random() * 10) + 1
@@ -462,6 +511,134 @@ class Digibot(Dobot):
     # DIGIBOT CONTROLS
     ######################
     """Low level functions for communicating direct to the Dobot"""
+    def _send_command(self, msg, wait=False):
+        """Replaces pydobot's send and blocking read with the pipelined transport.
+        Immediate commands (queries, queue control) return the reply.
+        Queued commands return a Future of the reply, so the next command
+        can go straight out, unless wait, which returns the reply once
+        the Dobot has executed the command."""
+        if self.transport is None:
+            self.transport = DobotTransport(self.ser, verbose=self.verbose)
+        if isinstance(msg.ctrl, ControlValues):
+            msg.ctrl = msg.ctrl.value
+        if not msg.ctrl & ControlValues.TWO.value:
+            return self.transport.request(msg)
+
+        # queued, so hold back while the arm has enough to be getting on with
+        with self.flow.admit:
+            self.flow.throttle()
+            future = self.transport.submit(msg)
+            self.flow.issue(future)
+        if not wait:
+            return future
+
+        response = future.result(self.transport.reply_timeout)
+        expected_idx = queued_index(response)
+        logging.debug(f'waiting for command {expected_idx}')
+        self.flow.wait_for(expected_idx)
+        return response
+
+    def _get_queued_cmd_current_index(self):
+        msg = Message()
+        msg.id = CommunicationProtocolIDs.GET_QUEUED_CMD_CURRENT_INDEX
+        return queued_index(self._send_command(msg))
+
+    def close(self):
+        self.flow.close()
+        if self.transport is not None:
+            self.transport.close()
+        self.flow.report()
+        self.report_pose()
+        logging.info(f'gesture library: {self.gestures.stats()}')
+        super().close()
+
+    ######################
+    # TRACKED POSE
+    ######################
+    """The pose is predicted from the target of every PTP, arc and CP command
+    issued, i.e. where the arm will be once the queue has drained. It is
+    resynced with a real pose() when it can't be predicted (a home, a
+    joint move or a queue clear), and every resync_period seconds, which
+    also measures how far the prediction drifted. A periodic resync waits
+    until the queue has drained, as the real pose is mid-motion until then."""
+    def tracked_pose(self) -> list:
+        """Predicted x, y, z, r of the pen"""
+        if self.tracked is None:
+            self.resync_pose()
+        elif monotonic() >= self.next_resync and not self.flow.depth():
+            # NB - the queue watcher keeps the depth fresh, so checking it
+            # is free, and a resync is deferred until nothing is queued
+            self.resync_pose()
+        self.predicted_reads += 1
+        return list(self.tracked)
+
+    def resync_pose(self):
+        """Replaces the predicted pose with a real pose() query"""
+        x, y, z, r = self.pose()[:4]
+        self.pose_queries += 1
+        if self.tracked is not None:
+            self.last_drift = ((x - self.tracked[0]) ** 2 + (y - self.tracked[1]) ** 2
+                               + (z - self.tracked[2]) ** 2) ** 0.5
+            self.max_drift = max(self.max_drift, self.last_drift)
+            if self.last_drift > 1:
+                logging.info(f'tracked pose drifted {self.last_drift:.1f} mm in {self.moves_since_sync} moves')
+        self.tracked = [x, y, z, r]
+        self.pose_synced = monotonic()
+        self.next_resync = self.pose_synced + self.resync_period
+        self.moves_since_sync = 0
+
+    def track_move(self, x, y, z, r, relative: bool = False):
+        """Moves the predicted pose to the target of a command just issued"""
+        if self.tracked is None:
+            return
+        if relative:
+            self.tracked = [self.tracked[0] + x, self.tracked[1] + y,
+                            self.tracked[2] + z, self.tracked[3] + r]
+        else:
+            self.tracked = [x, y, z, r]
+        self.moves_since_sync += 1
+
+    def invalidate_pose(self):
+        """The pose can't be predicted, so resync on the next read"""
+        self.tracked = None
+
+    def queue_idle(self) -> bool:
+        """True if the Dobot has executed every queued command issued"""
+        return self.flow.idle()
+
+    def pose_stats(self) -> dict:
+        """Staleness of the predicted pose, drift in mm"""
+        return {'pose_queries': self.pose_queries,
+                'predicted_reads': self.predicted_reads,
+                'moves_since_sync': self.moves_since_sync,
+                'seconds_since_sync': monotonic() - self.pose_synced,
+                'last_drift': self.last_drift,
+                'max_drift': self.max_drift}
+
+    def report_pose(self):
+        stats = self.pose_stats()
+        logging.info(f'tracked pose: {stats["predicted_reads"]} reads from {stats["pose_queries"]} pose queries, '
+                     f'{stats["moves_since_sync"]} moves and {stats["seconds_since_sync"]:.1f} seconds since sync, '
+                     f'drift last {stats["last_drift"]:.1f} mm max {stats["max_drift"]:.1f} mm')
+
+    def _set_ptp_cmd(self, x, y, z, r, mode, wait):
+        if mode in (PTPMode.JUMP_XYZ, PTPMode.MOVJ_XYZ, PTPMode.MOVL_XYZ, PTPMode.JUMP_MOVL_XYZ):
+            self.track_move(x, y, z, r)
+        elif mode in (PTPMode.MOVL_INC, PTPMode.MOVJ_XYZ_INC):
+            self.track_move(x, y, z, r, relative=True)
+        else:
+            # joint angles
+            self.invalidate_pose()
+        return super()._set_ptp_cmd(x, y, z, r, mode, wait)
+
+    def _set_queued_cmd_clear(self):
+        # the arm stops wherever it has got to
+        self.invalidate_pose()
+        response = super()._set_queued_cmd_clear()
+        self.flow.flush()
+        return response
+
+
     def draw_stave(self, staves: int = 1):
         """Draws a  line across the middle of an A3 paper, symbolising a stave.
         Has optional function to draw multiple staves.
@@ -478,7 +655,7 @@ class Digibot(Dobot):
 
         # goto start position for line draw, without pen
         self.move_to(x, y_start, z, r)
-        input('insert pen, then press enter')
+        self.pen_prompt('insert pen, then press enter')
 
         if staves >= 1:
             # draw a line/ stave
@@ -502,13 +679,8 @@ class Digibot(Dobot):
             circumference point: size of arc in pixels across x axis
             end point x, end point y: distance from last/ previous position
              """
-        [x, y, z, r] = self.pose()[0:4]
-        for arc in arc_list:
-            circumference, dx, dy = arc[0], arc[1], arc[2]
-            self.arc(x + circumference, y, z, r, x + dx, y + dy, z, r)
-            x += dx
-            y += dy
-            sleep(0.2)
+        x, y, z, r = self.tracked_pose()
+        self.stream_path(squiggle_path(x, y, z, arc_list))
 
     def arc(self, x, y, z, r, cir_x, cir_y, cir_z, cir_r, wait=False):
         """Draws an arc defined by a) circumference of arc (x, y, z, r),
@@ -526,8 +698,59 @@ class Digibot(Dobot):
         msg.params.extend(bytearray(struct.pack('f', cir_y)))
         msg.params.extend(bytearray(struct.pack('f', cir_z)))
         msg.params.extend(bytearray(struct.pack('f', cir_r)))
+        self.track_move(cir_x, cir_y, cir_z, cir_r)
         return self._send_command(msg, wait)
 
+    def draw_gesture(self, family: str, size: float = 1, span: float = 1.0,
+                     scale: float = 1.0, angle: float = 0.0):
+        """Draws a gesture from the GestureLibrary at the pen.
+        Args:
+            family: 'squiggle', 'note_head' or 'dot'
+            size: number of arcs of a squiggle, diameter of a note head
+            span: extent of each arc of a squiggle in mm
+            scale: scale of the shape
+            angle: rotation of the shape in radians"""
+        x, y, z, r = self.tracked_pose()
+        points, speeds = self.gestures.place(family, x, y, z, size=size, span=span,
+                                             scale=scale, angle=angle)
+        return self.stream_path(points, speeds=speeds)
+
+    def stream_path(self, points, velocity: float = None, speeds=None):
+        """Streams a compiled gesture (see gestures.py) as CP commands,
+        blending the velocity through the points so the arm flows through
+        the whole gesture without stopping. The points go out in bursts
+        of at most cp_lookahead minus the queue depth, each after its own
+        throttle, so the arm always has the next few tens of points queued
+        but a long gesture never overflows the Dobot's queue.
+        Args:
+            points: (n, 3) array of x, y, z
+            velocity: top velocity in mm/s, default is the arm speed
+            speeds: optional velocity of each point as a fraction of velocity,
+                e.g. from the GestureLibrary. Default blends them here
+        Returns:
+            list of Futures of the replies"""
+        x, y, z, r = self.tracked_pose()
+        if speeds is None:
+            velocities = blend_velocity(points, velocity or self.arm_speed, start=(x, y, z))
+        else:
+            velocities = speeds * (velocity or self.arm_speed)
+
+        frames = cp_frames(points, velocities)
+        size = CP_FRAME.itemsize
+        futures = []
+        sent = 0
+        while sent < len(points):
+            with self.flow.admit:
+                self.flow.throttle(lookahead=self.cp_lookahead)
+                count = min(len(points) - sent, max(1, self.cp_lookahead - self.flow.depth()))
+                burst = self.transport.submit_burst(CP_COMMAND, frames[sent * size:(sent + count) * size], count)
+                for future in burst:
+                    self.flow.issue(future)
+            futures += burst
+            sent += count
+        self.track_move(*points[-1].tolist(), r)
+        return futures
+
     def follow_path(self, path):
         for point in path:
             queue_index = self.move_to(point[0], point[1], point[2], 0)
@@ -541,7 +764,8 @@ class Digibot(Dobot):
         msg.params.extend(bytearray(struct.pack('f', y)))
         msg.params.extend(bytearray(struct.pack('f', z)))
         msg.params.extend(bytearray(struct.pack('f', velocity)))
-
+        if self.tracked is not None:
+            self.track_move(x, y, z, self.tracked[3])
         return self._send_command(msg, wait)
 
     # todo - continuous trajectory - test circle
@@ -578,6 +802,7 @@ class Digibot(Dobot):
         msg = Message()
         msg.id = CommunicationProtocolIDs.SET_HOME_CMD
         msg.ctrl = ControlValues.THREE
+        self.invalidate_pose()
         return self._send_command(msg, wait=True)
 
     def clear_alarms(self) -> None:
@@ -585,11 +810,12 @@ class Digibot(Dobot):
         msg = Message()
         msg.id = 20 # this should be 21, but that doesnt work!!
         msg.ctrl = 0x01
-        self._send_command(msg)  # empty response
+        # empty response, so don't wait on it
+        self.transport.submit(msg)
 
     def dot(self):
         """draws a small dot at current position"""
-        self.note_head(1)
+        self.draw_gesture('dot')
 
     def note_head(self, size: float = 5):
         """draws a circle at the current position.
@@ -599,8 +825,7 @@ class Digibot(Dobot):
             drawing: True = pen on paper
             wait: True = wait till sequence finished"""
 
-        (x, y, z, r, j1, j2, j3, j4) = self.pose()
-        self.arc(x + size, y, z, r, x + 0.01, y + 0.01, z, r)
+        self.draw_gesture('note_head', size=size)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,451 @@
+# install python modules
+import struct
+import logging
+from collections import deque
+from concurrent.futures import Future
+from threading import Thread, Lock, Condition
+from time import monotonic, sleep
+import numpy as np
+
+# install dobot modules
+from pydobot.message import Message
+
+HEADER = b'\xaa\xaa'
+
+# a whole continuous path (CP) command frame, cpMode then x, y, z, velocity
+CP_COMMAND = 91
+CP_FRAME = np.dtype([('header', '<u2'), ('length', 'u1'), ('id', 'u1'), ('ctrl', 'u1'),
+                     ('mode', 'u1'), ('x', '<f4'), ('y', '<f4'), ('z', '<f4'), ('velocity', '<f4'),
+                     ('checksum', 'u1')])
+
+
+class DobotTransport:
+    """Pipelined serial transport for the Dobot protocol.
+    Writing a command does not wait for its reply. A reader thread parses
+    the response frames off the serial port as they arrive, and matches
+    each one to the oldest pending command with the same command id
+    (the Dobot answers every command, in the order it received them).
+    So each command is a Future, and several can be in flight at once,
+    rather than paying the serial round trip on every command in turn.
+
+    Args:
+        ser: open pyserial port of the Dobot
+        verbose: print every frame sent and received, like pydobot
+        reply_timeout: default seconds to wait for a reply
+        read_timeout: seconds the reader blocks on the port before
+            checking if it should stop"""
+
+    def __init__(self, ser, verbose: bool = False, reply_timeout: float = 2.0, read_timeout: float = 0.05):
+        self.ser = ser
+        self.ser.timeout = read_timeout
+        self.verbose = verbose
+        self.reply_timeout = reply_timeout
+
+        # futures waiting on a reply, oldest first, by command id
+        self.pending = {}
+        self.send_times = {}
+        self.write_lock = Lock()
+        self.buffer = bytearray()
+
+        # stats
+        self.sent = 0
+        self.received = 0
+        self.bad_frames = 0
+        self.unmatched = 0
+        self.max_in_flight = 0
+        self.total_round_trip = 0.0
+        self.max_round_trip = 0.0
+
+        self.running = True
+        self.reader = Thread(target=self.read_loop, name='dobot reader', daemon=True)
+        self.reader.start()
+
+    @property
+    def in_flight(self) -> int:
+        """Commands sent and not yet answered"""
+        return sum(len(futures) for futures in self.pending.values())
+
+    def submit(self, msg: Message) -> Future:
+        """Writes a command to the Dobot without waiting for the reply.
+        Returns:
+            Future of the response Message"""
+        future = Future()
+        packet = msg.bytes()
+        with self.write_lock:
+            if not self.running:
+                raise ConnectionError('dobot transport is closed')
+            # NB - registered before the write, so the reply can never beat it
+            self.pending.setdefault(msg.id, deque()).append(future)
+            self.send_times[future] = monotonic()
+            self.ser.write(packet)
+            self.sent += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        if self.verbose:
+            print('pydobot: >>', msg)
+        return future
+
+    def submit_burst(self, command_id: int, packets: bytes, count: int) -> list:
+        """Writes count ready made command frames of the same command id
+        in one write, without waiting for the replies.
+        Returns:
+            list of Futures of the response Messages, in order"""
+        futures = [Future() for _ in range(count)]
+        with self.write_lock:
+            if not self.running:
+                raise ConnectionError('dobot transport is closed')
+            self.pending.setdefault(command_id, deque()).extend(futures)
+            now = monotonic()
+            for future in futures:
+                self.send_times[future] = now
+            self.ser.write(packets)
+            self.sent += count
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return futures
+
+    def request(self, msg: Message, timeout: float = None) -> Message:
+        """Writes a command and waits for its reply.
+        NB - on timeout the command stays pending, so a late reply is
+        still matched to it and not to the next command with its id"""
+        return self.submit(msg).result(timeout or self.reply_timeout)
+
+    def read_loop(self):
+        while self.running:
+            try:
+                data = self.ser.read(max(1, self.ser.in_waiting))
+            except Exception as error:
+                if self.running:
+                    logging.error(f'dobot transport: read failed: {error}')
+                    self.fail_pending(error)
+                break
+            if data:
+                self.buffer.extend(data)
+                self.parse_frames()
+
+    def parse_frames(self):
+        """Takes every complete frame off the front of the buffer
+        and resolves its pending command"""
+        buffer = self.buffer
+        while True:
+            start = buffer.find(HEADER)
+            if start < 0:
+                # keep a trailing header byte that may be half a header
+                del buffer[:max(0, len(buffer) - 1)]
+                return
+            if start:
+                del buffer[:start]
+            if len(buffer) < 3:
+                return
+            length = buffer[2]
+            end = 3 + length + 1
+            if len(buffer) < end:
+                return
+
+            # checksum makes the payload (id, ctrl, params) sum to 0 mod 256
+            if length < 2 or (sum(buffer[3:end])) % 256:
+                self.bad_frames += 1
+                # resync on the next header
+                del buffer[:2]
+                continue
+
+            msg = Message(bytes(buffer[:end]))
+            del buffer[:end]
+            self.resolve(msg)
+
+    def resolve(self, msg: Message):
+        self.received += 1
+        if self.verbose:
+            print('pydobot: <<', msg)
+        with self.write_lock:
+            futures = self.pending.get(msg.id)
+            future = futures.popleft() if futures else None
+            sent = self.send_times.pop(future, None)
+        if future is None:
+            self.unmatched += 1
+            logging.debug(f'dobot transport: reply to command {msg.id} with nothing pending')
+            return
+
+        round_trip = monotonic() - sent
+        self.total_round_trip += round_trip
+        self.max_round_trip = max(self.max_round_trip, round_trip)
+        future.set_result(msg)
+
+    def fail_pending(self, error: Exception):
+        with self.write_lock:
+            futures = [future for queue in self.pending.values() for future in queue]
+            self.pending.clear()
+            self.send_times.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def stats(self) -> dict:
+        """Traffic and round trip (send to reply) stats, in seconds"""
+        return {'sent': self.sent,
+                'received': self.received,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'bad_frames': self.bad_frames,
+                'unmatched': self.unmatched,
+                'mean_round_trip': self.total_round_trip / self.received if self.received else 0.0,
+                'max_round_trip': self.max_round_trip}
+
+    def report(self):
+        stats = self.stats()
+        logging.info(f'dobot transport: {stats["sent"]} sent, {stats["received"]} received, '
+                     f'max {stats["max_in_flight"]} in flight, '
+                     f'{stats["bad_frames"]} bad frames, {stats["unmatched"]} unmatched, '
+                     f'round trip mean {1000 * stats["mean_round_trip"]:.1f} ms '
+                     f'max {1000 * stats["max_round_trip"]:.1f} ms')
+
+    def close(self):
+        """Stops the reader and fails any commands still waiting on a reply.
+        NB - does not close the port, which belongs to the Dobot"""
+        with self.write_lock:
+            self.running = False
+        self.reader.join()
+        self.fail_pending(ConnectionError('dobot transport closed'))
+        self.report()
+
+
+def queued_index(response: Message) -> int:
+    """Queued command index the Dobot returns for a queued command"""
+    return struct.unpack_from('<Q', response.params, 0)[0]
+
+
+def cp_frames(points: np.ndarray, velocities: np.ndarray) -> bytes:
+    """Packs a path into queued absolute CP command frames, all at once.
+    Args:
+        points: (n, 3) array of x, y, z
+        velocities: (n,) array of velocities in mm/s
+    Returns:
+        the frames end to end, for DobotTransport.submit_burst"""
+    frames = np.zeros(len(points), dtype=CP_FRAME)
+    frames['header'] = 0xAAAA
+    frames['length'] = CP_FRAME.itemsize - 4
+    frames['id'] = CP_COMMAND
+    frames['ctrl'] = 0x03
+    frames['mode'] = 1
+    frames['x'], frames['y'], frames['z'] = points[:, 0], points[:, 1], points[:, 2]
+    frames['velocity'] = velocities
+
+    # checksum makes the payload (id to velocity) sum to 0 mod 256
+    payload = frames.view(np.uint8).reshape(len(points), CP_FRAME.itemsize)[:, 3:-1]
+    frames['checksum'] = -payload.sum(axis=1, dtype=np.int64) % 256
+    return frames.tobytes()
+
+
+class QueueFlow:
+    """Flow control of the Dobot's command queue.
+    Every queued command the Dobot accepts returns its queued index,
+    and the Dobot reports the index it is executing, so the difference
+    is the depth of commands queued ahead of the arm. Producers call
+    throttle() before issuing a command, which blocks while the queue
+    is lookahead deep. So the arm always has the next few moves queued
+    and never idles between them, but never more than lookahead of them,
+    so what it draws is never far behind what Nebula is feeling.
+
+    A watcher thread queries the executing index back to back while
+    anything is queued, each query paced by its round trip through the
+    transport's reader thread, and wakes throttled and waiting producers
+    on every update. So they resume as soon as the arm takes the next
+    command, and the arm's idle time is measured from the moment the
+    queue drains, not from when a producer next looks.
+
+    Thread safe, as the drawbot or joystick thread and the main thread
+    (terminate homes the arm) both issue commands. The lock is never
+    held over the index query.
+
+    Args:
+        query_index: function returning the index the Dobot is executing
+        lookahead: target depth of commands queued ahead of the arm
+        retry: seconds the watcher waits after a failed index query"""
+
+    def __init__(self, query_index, lookahead: int = 4, retry: float = 0.1):
+        self.query_index = query_index
+        self.lookahead = lookahead
+        self.retry = retry
+
+        # futures of the queued commands issued and not yet executed
+        # NB - guarded, with current and the stats, by the lock,
+        # and updated is notified whenever current moves or the queue clears
+        self.lock = Lock()
+        self.updated = Condition(self.lock)
+        # held by a producer from its throttle() to its issue(), so
+        # producers on different threads can't overshoot lookahead together
+        self.admit = Lock()
+        self.issued = deque()
+        self.current = 0
+        self.flushes = 0
+        self.idle_since = None
+
+        # stats
+        self.issued_count = 0
+        self.total_depth = 0
+        self.max_depth = 0
+        self.throttles = 0
+        self.throttled_seconds = 0.0
+        self.idle_seconds = 0.0
+
+        self.running = True
+        self.watcher = Thread(target=self.watch, name='dobot queue watcher', daemon=True)
+        self.watcher.start()
+
+    def depth(self) -> int:
+        """Commands queued ahead of the arm, as of the last index query"""
+        with self.lock:
+            return self._depth()
+
+    def _depth(self) -> int:
+        # NB - called inside the lock
+        while self.issued:
+            future = self.issued[0]
+            # NB - an unanswered command is queued, or about to be
+            if not future.done():
+                break
+            if not future.exception() and queued_index(future.result()) > self.current:
+                break
+            self.issued.popleft()
+        return len(self.issued)
+
+    def refresh(self) -> int:
+        """Queries the executing index.
+        Returns:
+            depth of the queue"""
+        current = self.query_index()
+        with self.lock:
+            # NB - another thread's query may have answered later
+            self.current = max(self.current, current)
+            depth = self._depth()
+            if not depth and self.idle_since is None:
+                self.idle_since = monotonic()
+            self.updated.notify_all()
+            return depth
+
+    def watch(self):
+        """Refreshes the index while anything is queued, else sleeps until
+        a command is issued"""
+        while True:
+            with self.lock:
+                while self.running and not self._depth():
+                    self.updated.wait()
+                if not self.running:
+                    return
+            try:
+                self.refresh()
+            except Exception as error:
+                if self.running:
+                    logging.warning(f'dobot queue: index query failed: {error}')
+                    sleep(self.retry)
+
+    def throttle(self, timeout: float = None, lookahead: int = None):
+        """Blocks while the queue is lookahead deep, or until timeout.
+        Args:
+            lookahead: depth to hold back at, default self.lookahead"""
+        lookahead = lookahead or self.lookahead
+        with self.lock:
+            if self._depth() < lookahead:
+                return
+            start = monotonic()
+            while self._depth() >= lookahead:
+                remaining = None if timeout is None else timeout - (monotonic() - start)
+                if remaining is not None and remaining <= 0:
+                    logging.warning(f'dobot queue still {self._depth()} deep after {timeout} seconds')
+                    break
+                self.updated.wait(remaining)
+            self.throttles += 1
+            self.throttled_seconds += monotonic() - start
+
+    def issue(self, future: Future):
+        """Counts a queued command just sent"""
+        with self.lock:
+            if self.idle_since is not None:
+                self.idle_seconds += monotonic() - self.idle_since
+                self.idle_since = None
+            self.issued.append(future)
+            depth = len(self.issued)
+            self.issued_count += 1
+            self.total_depth += depth
+            self.max_depth = max(self.max_depth, depth)
+            # wake the watcher
+            self.updated.notify_all()
+
+    def wait_for(self, index: int):
+        """Blocks until the Dobot has executed the command at index,
+        or the queue is cleared, which drops it.
+        NB - also returns if the commands fail, e.g. the transport closes"""
+        with self.lock:
+            flushes = self.flushes
+            while self.current < index and self.flushes == flushes and self._depth():
+                self.updated.wait()
+
+    def idle(self) -> bool:
+        """True if the Dobot has executed every command issued"""
+        return not self.depth() or not self.refresh()
+
+    def flush(self):
+        """The Dobot's queue has been cleared"""
+        with self.lock:
+            self.issued.clear()
+            self.flushes += 1
+            if self.idle_since is None:
+                self.idle_since = monotonic()
+            self.updated.notify_all()
+
+    def close(self):
+        """Stops the watcher.
+        NB - before the transport closes, so it isn't left querying it"""
+        with self.lock:
+            self.running = False
+            self.updated.notify_all()
+        self.watcher.join()
+
+    def stats(self) -> dict:
+        """Queue depth, and time producers were throttled and the arm idle, in seconds"""
+        with self.lock:
+            return {'issued': self.issued_count,
+                    'depth': len(self.issued),
+                    'mean_depth': self.total_depth / self.issued_count if self.issued_count else 0.0,
+                    'max_depth': self.max_depth,
+                    'throttles': self.throttles,
+                    'throttled_seconds': self.throttled_seconds,
+                    'idle_seconds': self.idle_seconds}
+
+    def report(self):
+        stats = self.stats()
+        logging.info(f'dobot queue: {stats["issued"]} commands, depth mean {stats["mean_depth"]:.1f} '
+                     f'max {stats["max_depth"]} (lookahead {self.lookahead}), '
+                     f'{stats["throttles"]} throttles for {stats["throttled_seconds"]:.1f} seconds, '
+                     f'arm idle {stats["idle_seconds"]:.1f} seconds')
+
+
+if __name__ == "__main__":
+    import serial
+    from serial.tools import list_ports
+    from pydobot.enums.CommunicationProtocolIDs import CommunicationProtocolIDs
+
+    logging.basicConfig(level=logging.INFO)
+
+    # find available ports and locate Dobot (-1)
+    available_ports = list_ports.comports()
+    print(f'available ports: {[x.device for x in available_ports]}')
+    port = serial.Serial(available_ports[-1].device, baudrate=115200)
+    transport = DobotTransport(port)
+
+    # 20 pose queries in flight at once, against 20 in turn
+    def get_pose() -> Message:
+        msg = Message()
+        msg.id = CommunicationProtocolIDs.GET_POSE
+        return msg
+
+    start = monotonic()
+    for _ in range(20):
+        transport.request(get_pose())
+    print(f'20 poses in turn took {monotonic() - start:.3f} seconds')
+
+    start = monotonic()
+    futures = [transport.submit(get_pose()) for _ in range(20)]
+    [future.result(2.0) for future in futures]
+    print(f'20 poses pipelined took {monotonic() - start:.3f} seconds')
+
+    transport.close()
+    port.close()
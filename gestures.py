@@ -0,0 +1,225 @@
+"""
+Gesture compiler: turns the drawbot's gestures into dense point sequences,
+to stream to the Dobot as one burst of continuous path (CP) commands,
+rather than one arc at a time with a pause between each.
+Points are (n, 3) float arrays of x, y, z in mm.
+
+GestureLibrary caches the parts of the gestures (each arc of the squiggle
+grid, and a unit note head) relative to where they start, so drawing one
+is only placing the cached points at the pen.
+"""
+from functools import lru_cache
+import numpy as np
+
+# spacing of the points along a path, in mm
+RESOLUTION = 0.5
+# fewest points on any arc
+MIN_POINTS = 6
+
+
+def arc_points(start, through, end, resolution: float = RESOLUTION) -> np.ndarray:
+    """Points of the arc from start, through a point on its circumference,
+    to end, like the Dobot's ARC command. A straight line if the three
+    points are collinear. Excludes the start point.
+    Args:
+        start, through, end: x, y points
+        resolution: spacing of the points in mm
+    Returns:
+        (n, 2) array of x, y"""
+    p0, p1, p2 = (np.asarray(point, dtype=np.float64) for point in (start, through, end))
+
+    # circumcentre of the three points
+    a, b = p1 - p0, p2 - p0
+    cross = a[0] * b[1] - a[1] * b[0]
+    if abs(cross) < 1e-9:
+        n = max(MIN_POINTS, int(np.ceil(np.hypot(*(p2 - p0)) / resolution)))
+        steps = np.linspace(0, 1, n + 1)[1:, np.newaxis]
+        return p0 + steps * (p2 - p0)
+    a2, b2 = a @ a, b @ b
+    centre = p0 + np.array([b[1] * a2 - a[1] * b2,
+                            a[0] * b2 - b[0] * a2]) / (2 * cross)
+    radius = np.hypot(*(p0 - centre))
+
+    # sweep from start to end the way that passes through the middle point
+    angles = np.arctan2(*(np.array([p0, p1, p2]) - centre).T[::-1])
+    to_through = (angles[1] - angles[0]) % (2 * np.pi)
+    sweep = (angles[2] - angles[0]) % (2 * np.pi)
+    if to_through > sweep:
+        sweep -= 2 * np.pi
+
+    n = max(MIN_POINTS, int(np.ceil(abs(sweep) * radius / resolution)))
+    theta = angles[0] + np.linspace(0, sweep, n + 1)[1:]
+    return centre + radius * np.column_stack((np.cos(theta), np.sin(theta)))
+
+
+def squiggle_path(x: float, y: float, z: float, arc_list: list, resolution: float = RESOLUTION) -> np.ndarray:
+    """Points of a squiggle from x, y, as Digibot.squiggle draws it.
+    Args:
+        arc_list: list of (circumference, dx, dy) tuples, see Digibot.squiggle
+    Returns:
+        (n, 3) array of x, y, z"""
+    segments = []
+    for circumference, dx, dy in arc_list:
+        segments.append(arc_points((x, y), (x + circumference, y), (x + dx, y + dy), resolution))
+        x += dx
+        y += dy
+    return with_z(np.concatenate(segments), z)
+
+
+def circle_path(x: float, y: float, z: float, size: float, resolution: float = RESOLUTION) -> np.ndarray:
+    """Points of a note head of diameter size, starting and ending at x, y,
+    as Digibot.note_head draws it
+    Returns:
+        (n, 3) array of x, y, z"""
+    radius = size / 2
+    n = max(MIN_POINTS, int(np.ceil(2 * np.pi * radius / resolution)))
+    # start on the left of the circle, at x, y
+    theta = np.pi + np.linspace(0, 2 * np.pi, n + 1)[1:]
+    points = np.column_stack((x + radius + radius * np.cos(theta), y + radius * np.sin(theta)))
+    return with_z(points, z)
+
+
+def with_z(points: np.ndarray, z: float) -> np.ndarray:
+    return np.column_stack((points, np.full(len(points), z)))
+
+
+def blend_velocity(points: np.ndarray, velocity: float, start=None,
+                   ramp: float = 5.0, floor: float = 0.2) -> np.ndarray:
+    """Velocity of each point of a path, so the arm flows through it:
+    ramping up from the start and down to the end over ramp mm, and
+    easing off through sharp corners, rather than stopping at each one.
+    Args:
+        points: (n, 3) path
+        velocity: top velocity in mm/s
+        start: x, y, z the arm starts the path from, default the first point
+        ramp: distance in mm to reach full velocity
+        floor: slowest velocity, as a fraction of velocity
+    Returns:
+        (n,) array of velocities"""
+    if start is None:
+        start = points[0]
+    steps = np.diff(np.vstack((start, points)), axis=0)
+    lengths = np.linalg.norm(steps, axis=1)
+    along = np.cumsum(lengths)
+    to_end = along[-1] - along
+
+    # ramp in and out
+    scale = np.sqrt(np.minimum(np.minimum(along, to_end), ramp) / ramp)
+
+    # turn at each point, from cos of the angle between its step and the next
+    directions = steps / np.maximum(lengths, 1e-9)[:, np.newaxis]
+    turn = np.ones(len(points))
+    turn[:-1] = (1 + np.einsum('ij,ij->i', directions[:-1], directions[1:])) / 2
+    return velocity * np.clip(np.minimum(scale, turn), floor, 1)
+
+
+class GestureLibrary:
+    """Cache of compiled gesture parts, relative to the point they start
+    from, so drawing a gesture is mostly placing cached points at the pen.
+
+    Squiggles are random, but drawn on a finite grid: the circumference,
+    dx and dy of each arc in steps of 0.2 mm within +-span. So each arc
+    of the grid is compiled once, with LRU eviction, and a fresh squiggle
+    is its random arcs' cached points end to end, each offset to where
+    the last one finished. Note heads are one cached circle of unit
+    diameter, scaled to size. The velocities are blended over the placed
+    points, so are right for any size.
+
+    Families:
+        'squiggle': size = number of arcs
+        'note_head': size = diameter in mm
+        'dot': a note head of size 1
+
+    Args:
+        capacity: most arcs cached at once (the grid has (10 * span) ** 3)
+        resolution: spacing of the points of an arc in mm
+        note_points: number of points of a note head, of any size
+        seed: seed of the squiggles, None = unseeded"""
+
+    def __init__(self, capacity: int = 4096, resolution: float = RESOLUTION,
+                 note_points: int = 32, seed: int = None):
+        self.resolution = resolution
+        self.rng = np.random.default_rng(seed)
+        self.squiggles = 0
+        self.arc = lru_cache(maxsize=capacity)(self.compile_arc)
+
+        # NB - cached, so shared by every placement
+        self.unit_note_head = circle_path(0.0, 0.0, 0.0, 1, np.pi / note_points)
+        self.unit_note_head.flags.writeable = False
+
+    def compile_arc(self, circumference: int, dx: int, dy: int) -> np.ndarray:
+        """Compiles an arc of a squiggle from 0, 0, in grid steps of 0.2 mm.
+        Returns:
+            (n, 2) points"""
+        points = arc_points((0.0, 0.0), (circumference / 5, 0.0), (dx / 5, dy / 5), self.resolution)
+        points.flags.writeable = False
+        return points
+
+    def squiggle(self, size: int, span: float = 1.0) -> np.ndarray:
+        """A fresh random squiggle from 0, 0, 0, on the grid of arcs of
+        the original squiggles, from the cached arcs.
+        Args:
+            size: number of arcs
+            span: extent of each arc in mm, 1 for the autonomous squiggles
+        Returns:
+            (n, 3) points"""
+        steps = int(round(span * 5))
+        cells = self.rng.integers(-steps, steps, (int(size), 3))
+        # each arc starts where the last one finished
+        starts = np.vstack(([0, 0], np.cumsum(cells[:-1, 1:], axis=0))) / 5
+        points = np.concatenate([self.arc(*cell) + start for cell, start in zip(cells.tolist(), starts)])
+        self.squiggles += 1
+        return with_z(points, 0.0)
+
+    def place(self, family: str, x: float, y: float, z: float, size: float = 1,
+              span: float = 1.0, scale: float = 1.0, angle: float = 0.0) -> tuple:
+        """A gesture starting at x, y, z, scaled and rotated about its start.
+        Args:
+            span: extent of each arc of a squiggle in mm
+            scale: scale of the shape
+            angle: rotation in radians, anticlockwise in x, y
+        Returns:
+            (n, 3) points, (n,) velocities as fractions of the top velocity"""
+        if family == 'squiggle':
+            points = self.squiggle(size, span)
+        elif family == 'note_head':
+            points = self.unit_note_head
+            scale *= size
+        elif family == 'dot':
+            points = self.unit_note_head
+        else:
+            raise ValueError(f'unknown gesture family: {family}')
+        if scale != 1 or angle:
+            cos, sin = scale * np.cos(angle), scale * np.sin(angle)
+            points = points @ np.array([[cos, sin, 0], [-sin, cos, 0], [0, 0, scale]])
+        points = points + (x, y, z)
+        return points, blend_velocity(points, 1.0, start=(x, y, z))
+
+    def stats(self) -> dict:
+        info = self.arc.cache_info()
+        return {'hits': info.hits, 'misses': info.misses, 'cached': info.currsize,
+                'squiggles': self.squiggles}
+
+
+if __name__ == "__main__":
+    from time import perf_counter
+
+    squiggle = squiggle_path(250, 0, 0, [(1, 1, 1), (-1, 0.5, -1), (0.5, -1, 0)])
+    note = circle_path(250, 0, 0, 5)
+    print(f'squiggle: {len(squiggle)} points, note head: {len(note)} points')
+    print(f'note head velocities: {np.round(blend_velocity(note, 100), 1)}')
+
+    start = perf_counter()
+    for _ in range(1000):
+        blend_velocity(squiggle_path(250, 0, 0, [(1, 1, 1), (-1, 0.5, -1)]), 100)
+    print(f'compiled 1000 squiggles in {perf_counter() - start:.3f} seconds')
+
+    library = GestureLibrary()
+    start = perf_counter()
+    for _ in range(1000):
+        library.place('squiggle', 250, 0, 0, size=2)
+    print(f'placed 1000 squiggles from cached arcs in {perf_counter() - start:.3f} seconds, {library.stats()}')
+    start = perf_counter()
+    for _ in range(1000):
+        library.place('note_head', 250, 0, 0, size=5)
+    print(f'placed 1000 cached note heads in {perf_counter() - start:.3f} seconds')
@@ -1,7 +1,5 @@
 from time import sleep, time
 from threading import Thread, Timer
-import pyaudio
-import numpy as np
 import logging
 from serial.tools import list_ports
 import hid
@@ -9,6 +7,9 @@ import hid
 from digibot import Digibot
 from nebula.nebula import Nebula
 from nebula.nebula_dataclass import NebulaDataClass
+from startup import Startup, non_interactive_prompt
+from audio_capture import open_capture
+from audio_analysis import PerceptStage
 
 class Main:
     """
@@ -22,20 +23,50 @@ class Main:
         continuous_line: Bool: True = will not jump between points
         speed: int the dynamic tempo of the all processes. 1 = slow, 10 = fast
         pen: bool - True for pen, false for pencil
+        engine: inference engine of the AI Factory (see AIFactory)
+        interactive: bool - False = do not wait for enter at the pen prompts
+        pen_prompt: optional hook called with the pen prompt message,
+            overrides interactive
+        history_path: optional .npz file to save the history of every
+            datadict write to at the end of the piece
+        calibration_path: optional .json file of the mic calibration for
+            this venue. Loaded at the start if it exists, saved at the end
+        channels: number of mic channels to open on each audio device
+        audio_devices: optional list of PyAudio input device indexes,
+            e.g. one per performer. Default is the default input device
+        percept_source: optional source to listen to instead of the mic,
+            e.g. a percept_sources.FileSource or SyntheticSource
+        lookahead: number of moves the robot keeps queued ahead of the arm
+        cp_lookahead: number of points of a gesture the robot keeps
+            queued ahead of the arm (see Digibot)
     """
     def __init__(self, duration_of_piece: int = 120,
                  continuous_line: bool = True,
                  speed: int = 5,
                  staves: int = 1,
                  pen: bool = True,
-                 joystick: bool = False):
+                 joystick: bool = False,
+                 engine: str = 'fused',
+                 interactive: bool = True,
+                 pen_prompt=None,
+                 history_path: str = None,
+                 calibration_path: str = None,
+                 channels: int = 1,
+                 audio_devices: list = None,
+                 percept_source=None,
+                 lookahead: int = 4,
+                 cp_lookahead: int = 32):
 
         # config logging for all modules
         logging.basicConfig(level=logging.INFO)
 
         # build initial dataclas
         # build the dataclass and fill with random number
-        self.datadict = NebulaDataClass()
+        # NB - the history keeps the last 16384 writes, so memory is bounded
+        # to about 14 MB (432 byte records, each stored twice)
+        self.datadict = NebulaDataClass(history=2 ** 14)
+        self.history_path = history_path
+        self.calibration_path = calibration_path
         logging.debug(f'Data dict initial values are = {self.datadict}')
 
         # find available ports and locate Dobot (-1)
@@ -43,32 +74,41 @@ class Main:
         print(f'available ports: {[x.device for x in available_ports]}')
         port = available_ports[-1].device
 
-        # start dobot communications
-        self.digibot = Digibot(port=port,
-                               datadict=self.datadict,
-                               verbose=False,
-                               duration_of_piece=duration_of_piece,
-                               continuous_line=continuous_line,
-                               speed=speed,
-                               staves=staves,
-                               pen=pen
-                               )
-
-        # start Nebula AI Factory
-        self.nebula = Nebula(datadict=self.datadict,
-                             speed=speed
-                             )
-        self.nebula.main_loop()
+        # choose how the robot asks for pen changes
+        if pen_prompt is None:
+            pen_prompt = input if interactive else non_interactive_prompt
 
-        # set up mic listening funcs
+        # set up mic listening vars
         self.CHUNK = 2 ** 11
         self.RATE = 44100
-        p = pyaudio.PyAudio()
-        self.stream = p.open(format=pyaudio.paInt16,
-                                  channels=1,
-                                  rate=self.RATE,
-                                  input=True,
-                                  frames_per_buffer=self.CHUNK)
+
+        # start dobot communications, Nebula AI Factory and the mic
+        # all in parallel, as none of them depend on each other
+        startup = Startup()
+        startup.add_phase('robot', self.start_digibot,
+                          port=port,
+                          duration_of_piece=duration_of_piece,
+                          continuous_line=continuous_line,
+                          speed=speed,
+                          staves=staves,
+                          pen=pen,
+                          pen_prompt=pen_prompt,
+                          lookahead=lookahead,
+                          cp_lookahead=cp_lookahead,
+                          cleanup=self.stop_digibot)
+        startup.add_phase('nebula', self.start_nebula,
+                          speed=speed,
+                          engine=engine,
+                          cleanup=self.stop_nebula)
+        startup.add_phase('audio', self.start_audio,
+                          channels=channels,
+                          audio_devices=audio_devices,
+                          percept_source=percept_source,
+                          cleanup=self.stop_audio)
+        # NB - raises if any phase failed, once the others are stopped
+        startup.run()
+
+        self.nebula.main_loop()
 
         # # start operating vars
         # self.joystick = joystick
@@ -90,34 +130,83 @@ class Main:
             dobot_thread = Thread(target=self.digibot.drawbot_control)
             dobot_thread.start()
 
+    ######################
+    # STARTUP PHASES
+    ######################
+    def start_digibot(self, port, duration_of_piece, continuous_line, speed, staves, pen, pen_prompt,
+                      lookahead, cp_lookahead):
+        """Homes the robot, and draws the staves"""
+        self.digibot = Digibot(port=port,
+                               datadict=self.datadict,
+                               verbose=False,
+                               duration_of_piece=duration_of_piece,
+                               continuous_line=continuous_line,
+                               speed=speed,
+                               staves=staves,
+                               pen=pen,
+                               pen_prompt=pen_prompt,
+                               lookahead=lookahead,
+                               cp_lookahead=cp_lookahead
+                               )
+
+    def start_nebula(self, speed, engine):
+        """Builds and warms up the Nebula AI Factory"""
+        self.nebula = Nebula(datadict=self.datadict,
+                             speed=speed,
+                             engine=engine
+                             )
+
+    def start_audio(self, channels, audio_devices, percept_source):
+        """Opens the mic streams, in callback mode into ring buffers,
+        or the offline percept source.
+        NB - they are started by the listener, so the rings don't fill
+        (and lap) while the other startup phases finish"""
+        if percept_source is not None:
+            self.capture = percept_source
+        else:
+            self.capture = open_capture(rate=self.RATE,
+                                        chunk=self.CHUNK,
+                                        channels=channels,
+                                        devices=audio_devices)
+        self.percept = PerceptStage(self.datadict,
+                                    rate=self.capture.rate,
+                                    chunk=self.capture.chunk,
+                                    channels=self.capture.channels,
+                                    calibration_path=self.calibration_path)
+        self.capture.open()
+
+    def stop_digibot(self):
+        """Stops the robot transport and closes the port, if another phase failed"""
+        self.digibot.close()
+
+    def stop_nebula(self):
+        """Closes the AI Factory engine, if another phase failed.
+        NB - its make_data loop never started, so won't close it"""
+        self.nebula.AI_factory.engine.close()
+
+    def stop_audio(self):
+        """Closes the mic streams, if another phase failed"""
+        self.capture.stop()
+
     def listener(self):
-        """Loop thread that listens to live sound and analyses amplitude.
+        """Loop thread that listens to live sound and analyses amplitude
+        and spectral features of every channel (see audio_analysis.PerceptStage).
         Normalises then stores this into the nebula dataclass for shared use."""
 
         print("Starting mic listening stream & thread")
+        self.capture.start()
         while self.running:
             if time() > self.end_time:
                 self.terminate()
                 self.running = False
                 break
-            # get amplitude from mic input
-            data = np.frombuffer(self.stream.read(
-                self.CHUNK,
-                exception_on_overflow=False),
-                                 dtype=np.int16)
-            peak = np.average(np.abs(data)) * 2
-
-            if peak > 2000:
-                bars = "#" * int(50 * peak / 2 ** 16)
-                logging.debug("MIC LISTENER: %05d %s" % (peak, bars))
-
-            # normalise it for range 0.0 - 1.0
-            normalised_peak = ((peak - 0) / (20000 - 0)) * (1 - 0) + 0
-            if normalised_peak > 1.0:
-                normalised_peak = 1.0
-
-            # put normalised amplitude into Nebula's dictionary for use
-            setattr(self.datadict, 'user_in', normalised_peak)
+            # get the next chunk of every channel from the capture rings
+            if not self.capture.read(self.percept.block, timeout=0.5):
+                continue
+
+            self.percept.process()
+
+        self.capture.stop()
         logging.info('quitting listener thread')
 
     def terminate(self):
@@ -127,6 +216,12 @@ class Main:
         self.digibot.home()
         self.digibot.close()
 
+        self.percept.save_calibration()
+
+        if self.history_path:
+            self.datadict.history.save(self.history_path)
+            print(f'saved datadict history to {self.history_path}')
+
 
 if __name__ == "__main__":
     Main(duration_of_piece=180,
@@ -1,56 +1,99 @@
 # install python modules
 import logging
 from random import random, randrange
-import tensorflow as tf
 import numpy as np
-from time import sleep
 
 # install Nebula modules
 from nebula.nebula_dataclass import NebulaDataClass
+from nebula.backends import build_engine, autotune
+from nebula.patch_board import PatchBoard
+from nebula.scheduler import Scheduler
 
 
 class AIFactory:
-    """Builds a factory of neural networks and manages the data flows."""
+    """Builds a factory of neural networks and manages the data flows.
+
+    Args:
+        datadict: the shared Nebula dataclass
+        speed: general tempo of the factory
+        engine: how the nets are run each tick (see backends.ENGINES).
+            'fused' = all nets in one compiled graph (default),
+            'xla' = the fused graph compiled by XLA,
+            'keras' = one keras predict per net,
+            'call' = one direct keras call per net,
+            'parallel' = independent nets run concurrently on a worker pool,
+            'numpy' = TensorFlow-free numpy forward pass of each net,
+            'table' = interpolated lookup tables sampled from the numpy nets,
+            'float16' or 'int8' = reduced precision TFLite variants of the nets
+                ('int8' is full integer inference, so drifts ~0.1 from float32),
+            'auto' = benchmark the autotune_engines at startup and keep
+                the fastest one that matches the original emissions
+        autotune_engines: engines the 'auto' engine tries, default is
+            backends.AUTOTUNE_ENGINES (the ones that are quick to build)
+        table_cache: optional directory to cache the 'table' engine grids
+        unroll_steps: number of ticks generated per engine call.
+            1 = predict every tick (default). K > 1 = unroll K ticks of the
+            patch board recurrence in one call into a trajectory buffer,
+            which then feeds the datadict one tick at a time
+        patch_board: list of patch_board.Net declaring the nets and their
+            input/output fields. Default is the EMR factory"""
 
     def __init__(self,
                  datadict: NebulaDataClass,
-                 speed: float = 1
+                 speed: float = 1,
+                 engine: str = 'fused',
+                 autotune_engines: list = None,
+                 table_cache: str = None,
+                 unroll_steps: int = 1,
+                 patch_board: list = None
                  ):
         print('Building the AI Factory')
-        # todo - build as a class where user only inputs the list of nets required
 
-        """Builds the individual neural nets that constitute the AI factory.
-        This will need modifying if and when a new AI factory design is implemented.
-        NB - the list of netnames will also need updating"""
+        """Builds the individual neural nets that constitute the AI factory
+        from the patch board declaration."""
 
         self.net_logging = False
         self.datadict = datadict
         self.global_speed = speed
         self.running = True
+        self.scheduler = Scheduler('ai factory')
 
-        # instantiate nets as objects and make  models
-        print('MoveRNN initialization')
-        self.move_net = tf.keras.models.load_model('nebula/models/EMR-full-sept-2021_RNN_skeleton_data.nose.x.h5')
-        print('AffectRNN initialization')
-        self.affect_net = tf.keras.models.load_model('nebula/models/EMR-full-sept-2021_RNN_bitalino.h5')
-        print('MoveAffectCONV2 initialization')
-        self.move_affect_net = tf.keras.models.load_model('nebula/models/EMR-full-sept-2021_conv2D_move-affect.h5')
-        print('AffectMoveCONV2 initialization')
-        self.affect_move_net = tf.keras.models.load_model('nebula/models/EMR-full-sept-2021_conv2D_affect-move.h5')
-        print('MoveAffectCONV2 initialization')
-        self.affect_perception = tf.keras.models.load_model('nebula/models/EMR-full-sept-2021_conv2D_move-affect.h5')
-
-        tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
-
-        # name list for nets that align to factory above
-        self.netnames = ['move_rnn',
-                         'affect_rnn',
-                         'move_affect_conv2',
-                         'affect_move_conv2',
-                         'self_awareness',  # Net name for self-awareness
-                         'master_output']  # input for self-awareness
-
-        self.net_patch_board = 0
+        # compile the patch board into index arrays over the datadict fields
+        # NB - the registry loads each model file once, and shares it between nets
+        self.plan = PatchBoard(patch_board).compile()
+        self.net_paths = self.plan.model_paths
+
+        # datadict field of each entry in the board state:
+        # net outputs in board order, then master output, then other inputs
+        self.netnames = self.plan.fields
+
+        # netnames index that feeds each net on the patch board (see make_tick)
+        self.board_inputs = self.plan.input_index
+
+        # datadict array index of each netnames field
+        self.state_index = self.datadict.field_index(self.netnames)
+
+        # trajectory buffer for unrolled generation
+        self.unroll_steps = unroll_steps
+        self.trajectory = None
+        self.master_trajectory = None
+        self.trajectory_step = unroll_steps
+
+        # build the engine that runs the patch board
+        engine_options = {'table': {'cache_dir': table_cache}}
+        if engine == 'auto':
+            self.engine = autotune(self.net_paths, candidates=autotune_engines, options=engine_options)
+        else:
+            self.engine = build_engine(engine, self.net_paths, **engine_options.get(engine, {}))
+
+        # loaded nets by name
+        self.nets = dict(zip(self.plan.net_names, self.engine.nets))
+        print(f'AI Factory engine = {self.engine.name}')
+
+    def warm_up(self):
+        """Runs one prediction of the whole patch board without touching
+        the datadict, so the first tick does not pay for engine start up"""
+        self.engine.predict(np.zeros(self.plan.n_nets, dtype=np.float32))
 
     def make_data(self):
         """Makes a prediction for a given net and defined input var.
@@ -60,68 +103,148 @@ class AIFactory:
         Do not disturb - it has its own life cycle"""
 
         # now spin the plate and do its own ting
+        # NB - ticks fire on absolute deadlines, so the time spent
+        # predicting is taken out of the rhythm, not added to it
+        self.scheduler.start()
         while self.running:
             # get the first rhythm rate from the datadict
             rhythm_rate = getattr(self.datadict, 'rhythm_rate') # + self.global_speed
 
-            # PATCH BOARD - CROSS PLUGS NET OUTPUTS TO INPUTS
-            # get input vars from dict (NB not always self)
-            in_val1 = self.get_in_val(0)  # move RNN as input
-            in_val2 = self.get_in_val(1)  # affect RNN as input
-            in_val3 = self.get_in_val(2)  # move - affect as input
-            in_val4 = self.get_in_val(1)  # affect RNN as input
-
-            # send in vals to net object for prediction
-            pred1 = self.move_net.predict(in_val1, verbose=0)
-            pred2 = self.affect_net.predict(in_val2, verbose=0)
-            pred3 = self.move_affect_net.predict(in_val3, verbose=0)
-            pred4 = self.affect_move_net.predict(in_val4, verbose=0)
-
-            # special case for self awareness stream
-            self_aware_input = self.get_in_val(5)  # main movement as input
-            self_aware_pred = self.affect_perception.predict(self_aware_input, verbose=0)
+            if self.unroll_steps > 1:
+                self.make_buffered_tick()
+            else:
+                self.make_tick()
 
             # emits a stream of random poetry
             setattr(self.datadict, 'rnd_poetry', random())
 
-            logging.debug(f"  'move_rnn' in: {in_val1} predicted {pred1}")
-            logging.debug(f"  'affect_rnn' in: {in_val2} predicted {pred2}")
-            logging.debug(f"  move_affect_conv2' in: {in_val3} predicted {pred3}")
-            logging.debug(f"  'affect_move_conv2' in: {in_val4} predicted {pred4}")
-            logging.debug(f"  'self_awareness' in: {self_aware_input} predicted {self_aware_pred}")
-
-            # put predictions back into the dicts and master
-            self.put_pred(0, pred1)
-            self.put_pred(1, pred2)
-            self.put_pred(2, pred3)
-            self.put_pred(3, pred4)
-            self.put_pred(4, self_aware_pred)
-
-            sleep(rhythm_rate)
+            self.scheduler.wait(rhythm_rate)
+
+        self.scheduler.report()
+
+        # NB - closed here, not in quit, so a tick in flight can finish
+        self.engine.close()
+
+    def make_tick(self):
+        """Predicts the whole patch board once, and puts the emissions in the datadict"""
+        # PATCH BOARD - CROSS PLUGS NET OUTPUTS TO INPUTS
+        # get every field on the board once, then plug into each net
+        state = self.get_board_state()
+        in_vals = state[self.board_inputs]
+
+        # only nets whose input has changed are sent to the engine
+        preds = self.plan.run(self.engine, in_vals)
+
+        updates = {}
+        for which_dict, (net_name, in_val, pred) in enumerate(zip(self.plan.net_names, in_vals, preds)):
+            # NB - lazy args, so the arrays are only formatted when debugging
+            logging.debug("  '%s' in: %s predicted %s", net_name, in_val, pred)
+            updates.update(self.pick_pred(which_dict, pred[np.newaxis]))
+
+        # put predictions back into the dicts and master,
+        # as one update so readers never see half a tick
+        self.datadict.update(**updates)
+
+    def make_buffered_tick(self):
+        """Feeds the datadict with the next tick of the trajectory buffer.
+        The buffer is regenerated when it runs out, or when the net fields
+        have been overwritten from outside (e.g. random_dict_fill on a
+        high energy interrupt)"""
+        if self.trajectory_step >= self.unroll_steps or self.board_overwritten():
+            self.generate_trajectory()
+
+        step = self.trajectory_step
+        updates = {self.netnames[which_dict]: self.trajectory[step, which_dict]
+                   for which_dict in range(len(self.board_inputs))}
+        updates[self.plan.master] = self.master_trajectory[step]
+        self.datadict.update(**updates)
+        self.trajectory_step += 1
+
+    def board_overwritten(self) -> bool:
+        """True if any net field no longer holds the value last put there from the buffer"""
+        if self.trajectory_step == 0:
+            return False
+        last_step = self.trajectory[self.trajectory_step - 1]
+        board = self.datadict.snapshot(*self.netnames[:len(self.board_inputs)])
+        return any(value != last_value for value, last_value in zip(board.values(), last_step))
+
+    def generate_trajectory(self):
+        """Unrolls unroll_steps ticks of the patch board from the current
+        datadict values, in one engine call if the engine can unroll.
+        NB - the self-awareness input follows the master output of the
+        trajectory itself, until the buffer is regenerated"""
+        # current value of every netnames field, plus a random choice
+        # of emission per net per tick (as put_pred)
+        state = self.get_board_state()
+        choices = np.random.randint(4, size=(self.unroll_steps, len(self.board_inputs)))
+
+        if hasattr(self.engine, 'unroll'):
+            preds = self.engine.unroll(state, self.board_inputs, choices)
+        else:
+            preds = unroll_board(self.engine, state, self.board_inputs, choices)
+
+        self.trajectory = np.take_along_axis(preds, choices[..., np.newaxis], axis=2)[..., 0]
+        self.master_trajectory = preds[:, -1]
+        self.trajectory_step = 0
+        logging.debug('generated trajectory of %s ticks: %s', self.unroll_steps, self.trajectory)
+
+    def get_board_state(self) -> np.ndarray:
+        """Current input value of every netnames field, all from the same datadict version"""
+        # NB master output holds a full output list, its index is the 1st data
+        return self.datadict.snapshot_values()[self.state_index].astype(np.float32)
 
     # function to get input value for net prediction from dictionary
     def get_in_val(self, which_dict):
-        # get the current value and reshape ready for input for prediction
-        input_val = getattr(self.datadict, self.netnames[which_dict])
+        # get the current value ready for input for prediction
+        # NB master output can hold a full output list, so only use the 1st data
+        input_val = np.ravel(getattr(self.datadict, self.netnames[which_dict]))[0]
         # print("input val", input_val)
-        input_val = np.reshape(input_val, (1, 1, 1))
-        input_val = tf.convert_to_tensor(input_val, np.float32)
         return input_val
 
     # function to put prediction value from net into dictionary
     def put_pred(self, which_dict, pred):
+        self.datadict.update(**self.pick_pred(which_dict, pred))
+
+    def pick_pred(self, which_dict, pred) -> dict:
+        """Datadict updates for one net's emissions.
+        Returns:
+            dict of master output: the full output list,
+            and the net's field: one random emission"""
         # save full output list to master output field
         out_pred_val = pred[0]
-        setattr(self.datadict, 'master_output', out_pred_val)
         # print(f"master move output ==  {out_pred_val}")
 
         # get random variable and save to data dict
         individual_val = out_pred_val[randrange(4)]
-        setattr(self.datadict, self.netnames[which_dict], individual_val)
+        return {self.plan.master: out_pred_val,
+                self.netnames[which_dict]: individual_val}
 
     def quit(self):
         self.running = False
 
+
+def unroll_board(engine, state: np.ndarray, board_inputs: np.ndarray, choices: np.ndarray) -> np.ndarray:
+    """Runs the patch board recurrence for several ticks, one engine call per tick.
+    Args:
+        engine: the AI Factory engine
+        state: current values of the netnames fields: the net outputs,
+            then master output, then any other inputs
+        board_inputs: netnames index that feeds each net
+        choices: array of shape (ticks, nets), which emission is put back per net
+    Returns:
+        array of shape (ticks, nets, 4) of the raw emissions of each tick"""
+    n_nets = len(board_inputs)
+    preds = np.empty((len(choices),) + (n_nets, 4), dtype=np.float32)
+    state = state.copy()
+    for tick, tick_choices in enumerate(choices):
+        preds[tick] = engine.predict(state[board_inputs])
+
+        # as put_pred - each net field gets its chosen emission,
+        # and master output the first emission of the last net
+        state[:n_nets] = preds[tick, np.arange(n_nets), tick_choices]
+        state[n_nets] = preds[tick, -1, 0]
+    return preds
+
 if __name__ == "__main__":
     test_data_dict = NebulaDataClass()
     test = AIFactory(test_data_dict)
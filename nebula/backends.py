@@ -0,0 +1,171 @@
+# install python modules
+import logging
+from importlib import import_module
+from time import perf_counter
+import numpy as np
+
+# install Nebula modules
+from nebula.model_registry import registry
+
+
+class Engine:
+    """Interface of an AI Factory inference engine.
+    An engine runs all the nets on the patch board for one tick.
+
+    Subclasses set:
+        name: the name the engine is registered under
+    and implement:
+        predict(in_vals, slots=None): array (n_nets,) of inputs -> array (n_nets, 4)
+            of emissions. slots is an optional boolean mask of the nets that
+            need evaluating; rows outside it may be left unevaluated
+    and may implement:
+        unroll(state, board_inputs, choices): several ticks in one call
+            (see ai_factory.unroll_board)
+        prepare(**options): class method called before the nets are loaded
+        close(): releases anything the engine holds on to (e.g. worker threads)
+
+    Args:
+        nets: list of loaded nets, one per slot on the patch board"""
+
+    name = None
+
+    def __init__(self, nets: list):
+        self.nets = nets
+
+        # slots that share a model can be batched into one call
+        groups = {}
+        for slot, net in enumerate(nets):
+            groups.setdefault(id(net), (net, []))[1].append(slot)
+        self.groups = [(net, np.array(slots)) for net, slots in groups.values()]
+
+    @classmethod
+    def prepare(cls, **options):
+        pass
+
+    def predict(self, in_vals: np.ndarray, slots: np.ndarray = None) -> np.ndarray:
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def group_inputs(self, in_vals: np.ndarray, slots: np.ndarray = None):
+        """Yields (net, slots, batch of inputs) for each model that needs evaluating"""
+        for net, group_slots in self.groups:
+            if slots is not None:
+                group_slots = group_slots[slots[group_slots]]
+                if not len(group_slots):
+                    continue
+            yield net, group_slots, np.reshape(in_vals[group_slots], (-1, 1, 1)).astype(np.float32)
+
+
+# registered engines: name: (module, class name, model registry backend)
+# NB - modules are only imported when the engine is built,
+# so TensorFlow-free engines never pull in TensorFlow
+ENGINES = {'keras': ('nebula.engines', 'KerasEngine', 'keras'),
+           'call': ('nebula.engines', 'DirectCallEngine', 'keras'),
+           'fused': ('nebula.engines', 'FusedKerasEngine', 'keras'),
+           'xla': ('nebula.engines', 'XLAEngine', 'keras'),
+           'parallel': ('nebula.engines', 'ParallelKerasEngine', 'keras'),
+           'numpy': ('nebula.numpy_engine', 'NumpyEngine', 'numpy'),
+           'table': ('nebula.lookup_engine', 'TableEngine', 'numpy'),
+           'float16': ('nebula.quantize', 'TFLiteEngine', 'float16'),
+           'int8': ('nebula.quantize', 'TFLiteEngine', 'int8')}
+
+# engines autotune tries by default, the ones that are quick to build.
+# NB - xla compiles, parallel starts a worker pool and float16/ int8
+# convert every model, so they are opt in
+AUTOTUNE_ENGINES = ['fused', 'call', 'numpy', 'table']
+
+
+def register_engine(name: str, module: str, class_name: str, model_backend: str):
+    """Adds an engine to the registry.
+    Args:
+        name: name to build the engine by
+        module: module holding the engine class
+        class_name: engine class, a subclass of Engine
+        model_backend: which model registry backend loads its nets"""
+    ENGINES[name] = (module, class_name, model_backend)
+
+
+def build_engine(name: str, model_paths: list, **options) -> Engine:
+    """Loads the nets and builds the named engine.
+    Args:
+        name: registered engine name
+        model_paths: model file for each slot on the patch board
+        options: passed on to the engine class"""
+    if name not in ENGINES:
+        raise ValueError(f'unknown AI Factory engine: {name}')
+    module, class_name, model_backend = ENGINES[name]
+    engine_class = getattr(import_module(module), class_name)
+    engine_class.prepare(**options)
+    nets = [registry.load(path, model_backend) for path in model_paths]
+    engine = engine_class(nets, **options)
+    engine.name = name
+    return engine
+
+
+def benchmark(engine: Engine, ticks: int = 300, max_seconds: float = 5) -> float:
+    """Mean seconds per tick of an engine, over up to ticks predictions"""
+    in_vals = np.random.uniform(0, 1, (ticks, len(engine.nets))).astype(np.float32)
+
+    # first call often pays for tracing or allocation
+    engine.predict(in_vals[0])
+    start = perf_counter()
+    for tick, tick_in_vals in enumerate(in_vals):
+        engine.predict(tick_in_vals)
+        if perf_counter() - start > max_seconds:
+            break
+    return (perf_counter() - start) / (tick + 1)
+
+
+def autotune(model_paths: list,
+             candidates: list = None,
+             ticks: int = 300,
+             tolerance: float = 1e-3,
+             options: dict = None) -> Engine:
+    """Builds each candidate engine, checks it against the numpy
+    reference engine (which matches keras) and microbenchmarks it.
+    Returns the fastest engine that passes the parity check.
+    Args:
+        model_paths: model file for each slot on the patch board
+        candidates: engine names to try, default is AUTOTUNE_ENGINES
+        ticks: number of ticks to benchmark each engine for
+        tolerance: max abs difference from the reference emissions
+        options: dict of engine name: options for that engine"""
+    options = options or {}
+    candidates = candidates or AUTOTUNE_ENGINES
+    print(f'Autotuning AI Factory engine from {candidates}')
+
+    reference = build_engine('numpy', model_paths)
+    parity_inputs = np.random.uniform(0, 1, (20, len(model_paths))).astype(np.float32)
+    expected = [reference.predict(in_vals) for in_vals in parity_inputs]
+
+    results = {}
+    engines = []
+    best_engine = None
+    best_time = None
+    for name in candidates:
+        try:
+            engine = build_engine(name, model_paths, **options.get(name, {}))
+        except Exception as error:
+            logging.info(f'autotune: could not build engine {name}: {error}')
+            continue
+        engines.append(engine)
+
+        error = max(float(np.max(np.abs(engine.predict(in_vals) - expect)))
+                    for in_vals, expect in zip(parity_inputs, expected))
+        tick_time = benchmark(engine, ticks)
+        results[name] = (tick_time, error)
+        print(f'\t{name}: {1000 * tick_time:.3f} ms per tick, max error {error:.2e}')
+
+        if error <= tolerance and (best_time is None or tick_time < best_time):
+            best_engine, best_time = engine, tick_time
+
+    for engine in engines:
+        if engine is not best_engine:
+            engine.close()
+
+    if best_engine is None:
+        raise RuntimeError(f'no AI Factory engine passed the parity check: {results}')
+    print(f'Autotune picked engine {best_engine.name}')
+    return best_engine
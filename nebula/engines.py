@@ -0,0 +1,189 @@
+# install python modules
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import tensorflow as tf
+
+# install Nebula modules
+from nebula.backends import Engine
+
+tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.ERROR)
+
+
+class KerasEngine(Engine):
+    """Runs each net of the AI Factory through its own Keras predict loop.
+    This is the original (per-net) behaviour of the factory.
+
+    Args:
+        nets: list of loaded keras models, one per slot on the patch board"""
+
+    name = 'keras'
+
+    def predict(self, in_vals: np.ndarray, slots: np.ndarray = None) -> np.ndarray:
+        """Makes one prediction per model, batching the nets that share it.
+        Args:
+            in_vals: array of shape (n_nets,) with one input value per net
+            slots: optional boolean mask of the nets to evaluate
+        Returns:
+            array of shape (n_nets, 4) with the raw emissions of each net"""
+        preds = np.zeros((len(self.nets), 4), dtype=np.float32)
+        for net, group_slots, batch in self.group_inputs(in_vals, slots):
+            preds[group_slots] = net.predict(batch, verbose=0)
+        return preds
+
+
+class DirectCallEngine(KerasEngine):
+    """Calls each keras net directly, skipping the predict loop.
+
+    Args:
+        nets: list of loaded keras models, one per slot on the patch board"""
+
+    name = 'call'
+
+    def predict(self, in_vals: np.ndarray, slots: np.ndarray = None) -> np.ndarray:
+        preds = np.zeros((len(self.nets), 4), dtype=np.float32)
+        for net, group_slots, batch in self.group_inputs(in_vals, slots):
+            preds[group_slots] = net(batch, training=False)
+        return preds
+
+
+class FusedKerasEngine(KerasEngine):
+    """Merges all the nets of the AI Factory into one compiled graph
+    with one input and one output per net, so that a whole patch board
+    is calculated in a single call. The nets keep their own weights,
+    so the emissions are the same as the per-net engine.
+
+    Args:
+        nets: list of loaded keras models, one per slot on the patch board"""
+
+    name = 'fused'
+    jit_compile = False
+
+    def __init__(self, nets: list):
+        super().__init__(nets)
+        print('Compiling fused AI Factory graph')
+        self.graph = tf.function(self._patch_board,
+                                 input_signature=[tf.TensorSpec(shape=(len(nets), 1, 1),
+                                                                dtype=tf.float32)],
+                                 jit_compile=self.jit_compile
+                                 )
+        self.unrolled_graph = tf.function(self._unroll, jit_compile=self.jit_compile)
+
+        # trace the graph now, so the first tick is not paying for it
+        self.predict(np.zeros(len(nets), dtype=np.float32))
+
+    def _patch_board(self, in_vals):
+        # each net gets its own (1, 1, 1) slice of the inputs
+        outputs = [net(in_vals[i:i + 1], training=False)
+                   for i, net in enumerate(self.nets)]
+        return tf.concat(outputs, axis=0)
+
+    def _unroll(self, state, board_inputs, choices):
+        # python loop is unrolled into the graph when it is traced
+        n_nets = len(self.nets)
+        preds = []
+        for tick in range(choices.shape[0]):
+            in_vals = tf.reshape(tf.gather(state, board_inputs), (n_nets, 1, 1))
+            tick_preds = self._patch_board(in_vals)
+            picked = tf.gather(tick_preds, choices[tick], axis=1, batch_dims=1)
+            state = tf.concat([picked, tick_preds[-1:, 0], state[n_nets + 1:]], axis=0)
+            preds.append(tick_preds)
+        return tf.stack(preds)
+
+    def unroll(self, state: np.ndarray, board_inputs: np.ndarray, choices: np.ndarray) -> np.ndarray:
+        """Runs several ticks of the patch board recurrence in one compiled call.
+        See ai_factory.unroll_board for the args"""
+        preds = self.unrolled_graph(tf.convert_to_tensor(state, tf.float32),
+                                    tf.convert_to_tensor(board_inputs, tf.int32),
+                                    tf.convert_to_tensor(choices, tf.int32))
+        return preds.numpy()
+
+    def predict(self, in_vals: np.ndarray, slots: np.ndarray = None) -> np.ndarray:
+        # the whole board is one call, so every net is evaluated
+        in_vals = np.reshape(in_vals, (len(self.nets), 1, 1)).astype(np.float32)
+        preds = self.graph(tf.convert_to_tensor(in_vals)).numpy()
+        logging.debug(f'fused graph predicted {preds}')
+        return preds
+
+
+class XLAEngine(FusedKerasEngine):
+    """The fused graph, compiled by XLA just-in-time.
+
+    Args:
+        nets: list of loaded keras models, one per slot on the patch board"""
+
+    name = 'xla'
+    jit_compile = True
+
+
+def configure_threading(intra_op_threads: int = None, inter_op_threads: int = None):
+    """Sets the TensorFlow thread pools. This only works before TensorFlow
+    has started its runtime (i.e. before the first model is loaded).
+    Args:
+        intra_op_threads: threads used inside one op (e.g. a matmul)
+        inter_op_threads: threads used to run independent ops"""
+    try:
+        if intra_op_threads is not None:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        if inter_op_threads is not None:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError:
+        logging.warning('TensorFlow is already running, keeping its thread settings: '
+                        f'intra op = {tf.config.threading.get_intra_op_parallelism_threads()}, '
+                        f'inter op = {tf.config.threading.get_inter_op_parallelism_threads()}')
+
+
+class ParallelKerasEngine(KerasEngine):
+    """Runs the independent nets of the patch board concurrently on a small
+    worker pool. Every net reads its input at the start of the tick, so
+    there are no dependencies between them within a tick. Each model is
+    compiled into its own graph, which releases the GIL while it runs.
+    Emissions are written back in board order, whichever net finishes first.
+
+    Args:
+        nets: list of loaded keras models, one per slot on the patch board
+        workers: size of the worker pool, default is one per model (up to the cpu count)
+        intra_op_threads: TensorFlow threads inside each op, default 1 so
+            the workers do not fight over the cores
+        inter_op_threads: TensorFlow threads for independent ops"""
+
+    name = 'parallel'
+
+    @classmethod
+    def prepare(cls, workers: int = None, intra_op_threads: int = 1, inter_op_threads: int = None):
+        configure_threading(intra_op_threads, inter_op_threads)
+
+    def __init__(self, nets: list, workers: int = None, intra_op_threads: int = 1,
+                 inter_op_threads: int = None):
+        super().__init__(nets)
+        workers = workers or min(len(self.groups), os.cpu_count() or 1)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ai-factory')
+        self.preds = np.zeros((len(nets), 4), dtype=np.float32)
+
+        print(f'Compiling {len(self.groups)} AI Factory graphs for {workers} workers')
+        self.graphs = [tf.function(lambda x, net=net: net(x, training=False),
+                                   input_signature=[tf.TensorSpec(shape=(None, 1, 1), dtype=tf.float32)])
+                       for net, _ in self.groups]
+
+        # trace the graphs now, so the first tick is not paying for it
+        self.predict(np.zeros(len(nets), dtype=np.float32))
+
+    def predict(self, in_vals: np.ndarray, slots: np.ndarray = None) -> np.ndarray:
+        in_vals = np.asarray(in_vals, dtype=np.float32)
+        jobs = []
+        for graph, (net, group_slots) in zip(self.graphs, self.groups):
+            if slots is not None:
+                group_slots = group_slots[slots[group_slots]]
+                if not len(group_slots):
+                    continue
+            batch = np.reshape(in_vals[group_slots], (-1, 1, 1))
+            jobs.append((group_slots, self.pool.submit(graph, batch)))
+
+        # collect in submission order, so the write back is deterministic
+        for group_slots, job in jobs:
+            self.preds[group_slots] = job.result().numpy()
+        return self.preds.copy()
+
+    def close(self):
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,54 @@
+# install python modules
+from collections import deque, namedtuple
+from threading import Event
+from time import monotonic
+
+FieldEvent = namedtuple('FieldEvent', ['name', 'old', 'new', 'time', 'version'])
+"""A datadict field change that a subscription fired on"""
+
+
+class Subscription:
+    """Subscription to a datadict field (see NebulaDataClass.subscribe).
+    Fires on every change of the field, or only when it crosses a threshold.
+    Fired events are queued (up to max_events, oldest are dropped) and
+    set a threading Event, so a loop can sleep on wait() and wake
+    the moment the subscription fires.
+
+    Args:
+        name: datadict field
+        threshold: fire when the field crosses this value, None = on every change
+        rising: True = fire on upward crossings, False = downward
+        max_events: length of the event queue"""
+
+    def __init__(self, name: str, threshold: float = None, rising: bool = True, max_events: int = 64):
+        self.name = name
+        self.threshold = threshold
+        self.rising = rising
+        self.events = deque(maxlen=max_events)
+        self.fired = Event()
+
+    def check(self, old: float, new: float, version: int):
+        """Called by the datadict writer, fires if the write matches"""
+        if self.threshold is None:
+            matched = new != old
+        elif self.rising:
+            matched = old < self.threshold <= new
+        else:
+            matched = old > self.threshold >= new
+        if matched:
+            self.events.append(FieldEvent(self.name, old, new, monotonic(), version))
+            self.fired.set()
+
+    def wait(self, timeout: float = None) -> bool:
+        """Sleeps until the subscription fires, or timeout.
+        Returns:
+            True if it fired"""
+        return self.fired.wait(timeout)
+
+    def poll(self) -> list:
+        """Takes all the events fired so far, oldest first"""
+        self.fired.clear()
+        events = []
+        while self.events:
+            events.append(self.events.popleft())
+        return events
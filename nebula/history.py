@@ -0,0 +1,84 @@
+# install python modules
+from time import monotonic
+import numpy as np
+
+
+class History:
+    """Fixed capacity time series of every datadict write.
+    Each record is (monotonic time, datadict version, all numeric values)
+    in a structured NumPy array. Every record is written twice, at i and
+    i + capacity, so the last n records are always one contiguous slice,
+    and windows are views into the buffer rather than copies.
+
+    NB - a window is live, later writes will overwrite it once the buffer
+    wraps, so copy it if it needs to be kept.
+
+    Args:
+        columns: dict of field name: slice of the datadict values array
+        n_values: length of the datadict values array
+        capacity: max number of records kept. Each record is
+            16 + 8 * n_values bytes, and is stored twice"""
+
+    def __init__(self, columns: dict, n_values: int, capacity: int = 2 ** 14):
+        self.columns = columns
+        self.capacity = capacity
+        self.dtype = np.dtype([('time', np.float64),
+                               ('version', np.int64),
+                               ('values', np.float64, (n_values,))])
+        self.buffer = np.zeros(2 * capacity, dtype=self.dtype)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, version: int, values: np.ndarray, time: float = None):
+        """Adds a record. NB - only the datadict writer (which holds the write lock) appends"""
+        if time is None:
+            time = monotonic()
+        position = self.count % self.capacity
+        self.buffer[position] = (time, version, values)
+        self.buffer[position + self.capacity] = self.buffer[position]
+        self.count += 1
+
+    def last(self, n: int = None) -> np.ndarray:
+        """View of the last n records, oldest first. Default is all of them"""
+        n = len(self) if n is None else min(n, len(self))
+        end = (self.count - 1) % self.capacity + self.capacity + 1 if self.count else 0
+        return self.buffer[end - n:end]
+
+    def window(self, seconds: float, now: float = None) -> np.ndarray:
+        """View of the records of the last seconds, oldest first"""
+        records = self.last()
+        if now is None:
+            now = monotonic()
+        start = np.searchsorted(records['time'], now - seconds, side='left')
+        return records[start:]
+
+    def field(self, name: str, seconds: float = None, n: int = None) -> tuple:
+        """Time series of one field, e.g. the last 2 seconds of user_in.
+        Args:
+            name: datadict field
+            seconds: length of the window, or
+            n: number of records (default is all of them)
+        Returns:
+            (times, values) views of the records"""
+        records = self.window(seconds) if seconds is not None else self.last(n)
+        column = self.columns[name]
+        values = records['values'][:, column]
+        if column.stop - column.start == 1:
+            values = values[:, 0]
+        return records['time'], values
+
+    def trend(self, name: str, seconds: float) -> float:
+        """Slope (change per second) of a least squares line through a field's window"""
+        times, values = self.field(name, seconds)
+        if len(times) < 2 or times[-1] == times[0]:
+            return 0.0
+        return float(np.polyfit(times - times[0], values, 1)[0])
+
+    def save(self, path: str):
+        """Saves a copy of the records, oldest first, for analysis after a piece"""
+        np.savez_compressed(path,
+                            records=self.last(),
+                            fields=np.array(list(self.columns)),
+                            starts=np.array([column.start for column in self.columns.values()]))
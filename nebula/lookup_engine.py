@@ -0,0 +1,135 @@
+# install python modules
+import os
+import logging
+import numpy as np
+
+# install Nebula modules
+from nebula.backends import Engine
+from nebula.model_registry import registry
+
+
+class ResponseTable:
+    """Precomputed response of one net, sampled on a dense grid of
+    scalar inputs. Predictions are answered by linear interpolation
+    between the grid points, so never touch the net itself.
+
+    Args:
+        net: the net to sample (keras model or NumpyNet), anything with predict()
+        size: number of grid points
+        value_range: (low, high) input range of the grid. Inputs outside are clipped
+        cache_path: optional .npz file to load the grid from, or save it to"""
+
+    def __init__(self, net,
+                 size: int = 2049,
+                 value_range: tuple = (-0.5, 1.5),
+                 cache_path: str = None):
+        self.low, self.high = value_range
+        self.size = size
+        self.step = (self.high - self.low) / (size - 1)
+        self.grid = np.linspace(self.low, self.high, size, dtype=np.float32)
+
+        if cache_path and self.load(cache_path):
+            logging.info(f'loaded response table from {cache_path}')
+        else:
+            self.values = self.sample(net, self.grid)
+            self.max_error = self.measure_error(net)
+            if cache_path:
+                self.save(cache_path)
+
+    @staticmethod
+    def sample(net, in_vals: np.ndarray) -> np.ndarray:
+        """Runs a batch of scalar inputs through the real net"""
+        return np.asarray(net.predict(np.reshape(in_vals, (-1, 1, 1)), verbose=0), dtype=np.float32)
+
+    def measure_error(self, net) -> float:
+        """Max abs error of the table against the real net, measured
+        half way between grid points, where interpolation is worst."""
+        midpoints = self.grid[:-1] + (self.step / 2)
+        error = np.abs(self.predict(midpoints) - self.sample(net, midpoints))
+        return float(error.max())
+
+    def predict(self, in_vals: np.ndarray) -> np.ndarray:
+        """Vectorised interpolation of the table.
+        Args:
+            in_vals: array of shape (n,) of scalar inputs
+        Returns:
+            array of shape (n, 4)"""
+        position = (np.clip(in_vals, self.low, self.high) - self.low) / self.step
+        index = np.minimum(position.astype(np.intp), self.size - 2)
+        fraction = (position - index)[:, np.newaxis]
+        lower = self.values[index]
+        return lower + (self.values[index + 1] - lower) * fraction
+
+    def save(self, cache_path: str):
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        np.savez(cache_path,
+                 values=self.values,
+                 value_range=np.array([self.low, self.high]),
+                 max_error=self.max_error)
+
+    def load(self, cache_path: str) -> bool:
+        """Loads the table from the cache, if it matches this grid"""
+        if not os.path.exists(cache_path):
+            return False
+        with np.load(cache_path) as cache:
+            if cache['values'].shape[0] != self.size \
+                    or not np.allclose(cache['value_range'], (self.low, self.high)):
+                return False
+            self.values = cache['values']
+            self.max_error = float(cache['max_error'])
+        return True
+
+
+class TableEngine(Engine):
+    """Runs the nets of the AI Factory as precomputed response tables.
+
+    Args:
+        nets: list of nets, one per slot on the patch board
+        size: number of grid points per table
+        value_range: (low, high) input range of the tables
+        cache_dir: optional directory for the table cache files"""
+
+    name = 'table'
+
+    def __init__(self, nets: list,
+                 size: int = 2049,
+                 value_range: tuple = (-0.5, 1.5),
+                 cache_dir: str = None):
+        super().__init__(nets)
+        print('Building AI Factory response tables')
+        self.tables = []
+        tables_by_path = {}
+        for net in nets:
+            # nets loaded from the same file share a table
+            path = getattr(net, 'path', None)
+            if path in tables_by_path:
+                self.tables.append(tables_by_path[path])
+                continue
+
+            # cached tables are keyed by the content hash of the model file
+            cache_path = None
+            if cache_dir and path:
+                cache_path = os.path.join(cache_dir, f'{registry.file_hash(path)}.table{size}.npz')
+            table = ResponseTable(net, size, value_range, cache_path)
+            print(f'response table for {path} max error vs model = {table.max_error}')
+
+            self.tables.append(table)
+            if path:
+                tables_by_path[path] = table
+
+        self.max_error = max(table.max_error for table in self.tables)
+
+        # stack all tables, so the whole board is one gather
+        self.low, self.high = value_range
+        self.step = self.tables[0].step
+        self.size = size
+        self.values = np.stack([table.values for table in self.tables])
+        self.slots = np.arange(len(self.tables))
+
+    def predict(self, in_vals: np.ndarray, slots: np.ndarray = None) -> np.ndarray:
+        # the whole board is one gather, so every net is evaluated
+        position = (np.clip(in_vals, self.low, self.high) - self.low) / self.step
+        index = np.minimum(position.astype(np.intp), self.size - 2)
+        fraction = (position - index)[:, np.newaxis]
+        lower = self.values[self.slots, index]
+        return lower + (self.values[self.slots, index + 1] - lower) * fraction
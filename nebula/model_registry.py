@@ -0,0 +1,120 @@
+# install python modules
+import os
+import json
+import hashlib
+import logging
+from threading import Lock
+import numpy as np
+
+
+class ModelRegistry:
+    """Loads each model file of the AI Factory once, and shares it between
+    all the roles (nets) that use it. Models are keyed by the content hash
+    of their file, so the same model under two names is still loaded once.
+
+    The numpy form of each model (layer configs and weights) is kept in an
+    on-disk cache, keyed by the same content hash, so later launches skip
+    parsing the HDF5 files. Each model is checked against keras (if
+    TensorFlow is installed) when it is converted, and never cached if
+    the numpy form drifts from it.
+
+    Args:
+        cache_dir: directory for the converted model cache"""
+
+    def __init__(self, cache_dir: str = 'nebula/models/cache'):
+        self.cache_dir = cache_dir
+        self.models = {}
+        self.hashes = {}
+        self.lock = Lock()
+
+    def file_hash(self, path: str) -> str:
+        """sha256 of the file contents, only recalculated if the file changes"""
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        if key not in self.hashes:
+            with open(path, 'rb') as model_file:
+                self.hashes[key] = hashlib.sha256(model_file.read()).hexdigest()
+        return self.hashes[key]
+
+    def load(self, path: str, backend: str = 'keras'):
+        """Returns the model for this file, loading it on first use.
+        Args:
+            path: path to the keras .h5 model file
+            backend: 'keras' for a tf.keras model, 'numpy' for a NumpyNet,
+                'float16' or 'int8' for a reduced precision TFLiteNet"""
+        with self.lock:
+            key = (backend, self.file_hash(path))
+            if key in self.models:
+                logging.info(f'model registry: sharing already loaded {path}')
+                return self.models[key]
+
+            if backend == 'keras':
+                import tensorflow as tf
+                # the factory never trains, so skip rebuilding the optimizer
+                model = tf.keras.models.load_model(path, compile=False)
+            elif backend == 'numpy':
+                from nebula.numpy_engine import NumpyNet
+                model = NumpyNet(path, weights=self.load_weights(path))
+            elif backend in ('float16', 'int8'):
+                from nebula.quantize import TFLiteNet, quantize_model, CACHE_SUFFIXES
+                quantized_path = self.cache_path(path, CACHE_SUFFIXES[backend])
+                if not os.path.exists(quantized_path):
+                    quantize_model(path, backend, quantized_path)
+                model = TFLiteNet(quantized_path)
+            else:
+                raise ValueError(f'unknown model backend: {backend}')
+
+            self.models[key] = model
+            return model
+
+    def cache_path(self, path: str, suffix: str = 'npz') -> str:
+        """Path in the cache for a converted form of this model file"""
+        return os.path.join(self.cache_dir, f'{self.file_hash(path)}.{suffix}')
+
+    def load_weights(self, path: str) -> tuple:
+        """Layer configs and weights of a model file, from the cache if possible.
+        Returns:
+            (list of layer configs, dict of layer name: list of weight arrays)"""
+        cache_path = self.cache_path(path)
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as cache:
+                layer_configs = json.loads(str(cache['layer_configs']))
+                weights = {}
+                for layer_config in layer_configs:
+                    name = layer_config['config']['name']
+                    weights[name] = [cache[f'{name}/{i}']
+                                     for i in range(int(cache[f'{name}/count']))]
+            logging.info(f'model registry: loaded {path} from cache {cache_path}')
+            return layer_configs, weights
+
+        from nebula.numpy_engine import load_h5_weights, NumpyNet, parity_check
+        layer_configs, weights = load_h5_weights(path)
+
+        # checked once, before it is cached, so every later launch runs a checked net
+        # NB - raises if it drifts, but only warns if keras can't load the model here
+        try:
+            import tensorflow as tf
+            keras_net = tf.keras.models.load_model(path, compile=False)
+        except Exception as error:
+            logging.warning(f'model registry: numpy form of {path} not checked against keras, '
+                            f'could not load it: {error.__class__.__name__}')
+        else:
+            error = parity_check(path, numpy_net=NumpyNet(path, weights=(layer_configs, weights)),
+                                 keras_net=keras_net)
+            logging.info(f'model registry: numpy form of {path} matches keras to {error:.1e}')
+
+        # save the converted form for next time
+        arrays = {'layer_configs': np.array(json.dumps(layer_configs))}
+        for name, layer_weights in weights.items():
+            arrays[f'{name}/count'] = np.array(len(layer_weights))
+            for i, weight in enumerate(layer_weights):
+                arrays[f'{name}/{i}'] = weight
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(f'{cache_path}.tmp', 'wb') as cache_file:
+            np.savez(cache_file, **arrays)
+        os.replace(f'{cache_path}.tmp', cache_path)
+        return layer_configs, weights
+
+
+# shared registry for all the Nebula modules
+registry = ModelRegistry()
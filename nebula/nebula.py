@@ -46,11 +46,15 @@ class Nebula:
             with the data generation.
 
     Args:
-        speed: general tempo/ feel of Nebula's response (0.5 ~ moderate fast, 1 ~ moderato; 2 ~ presto)"""
+        speed: general tempo/ feel of Nebula's response (0.5 ~ moderate fast, 1 ~ moderato; 2 ~ presto)
+        engine: inference engine of the AI Factory (see AIFactory)
+        unroll_steps: ticks generated per AI Factory engine call (see AIFactory)"""
 
     def __init__(self,
                  datadict: NebulaDataClass,
                  speed=1,
+                 engine: str = 'fused',
+                 unroll_steps: int = 1
                  ):
         print('building engine server')
 
@@ -65,7 +69,9 @@ class Nebula:
         logging.debug(f'Data dict initial values are = {self.datadict}')
 
         # Build the AI factory and pass it the data dict
-        self.AI_factory = AIFactory(self.datadict, speed)
+        self.AI_factory = AIFactory(self.datadict, speed, engine,
+                                    unroll_steps=unroll_steps)
+        self.AI_factory.warm_up()
 
     def main_loop(self):
         """Starts the server/ AI threads
@@ -1,43 +1,294 @@
-from dataclasses import dataclass
-from random import random, randrange
+from threading import Lock
+from time import sleep
+import numpy as np
+
+from nebula.history import History
+from nebula.events import Subscription
+
+# max number of mic channels with their own fields
+MAX_CHANNELS = 8
+
+
+class DataField:
+    """Named view of a slice of the NebulaDataClass array.
+    Reading gives a float (or a copy of the slice if it is longer than 1),
+    writing is a one field update.
+
+    Args:
+        offset: first index in the array
+        size: number of values
+        doc: what the field holds
+        write_size: number of values a write fills, if more than size"""
+
+    def __init__(self, offset: int, size: int = 1, doc: str = '', write_size: int = None):
+        self.offset = offset
+        self.size = size
+        self.slice = slice(offset, offset + size)
+        self.write_slice = slice(offset, offset + (write_size or size))
+        self.__doc__ = doc
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        if self.size == 1:
+            return float(instance.values[self.offset])
+        return instance.values[self.slice].copy()
+
+    def __set__(self, instance, value):
+        instance.update(**{self.name: value})
 
-# todo - dataclasses can be quite slow.
-#  Perhaps replace with record class, slots or other [HIGH]
 
-@dataclass
 class NebulaDataClass:
-    """Dataclass containing all the data emissions
-    and user input to and from Nebula"""
+    """Contains all the data emissions
+    and user input to and from Nebula.
+
+    All numeric fields live in one contiguous float64 array (values),
+    with a named view per field, so filling, snapshotting and
+    serialising the whole dict are single array operations.
+
+    It is shared between threads as a seqlock: every write bumps
+    a version counter before and after, so readers can take
+    consistent snapshots of several fields without locking,
+    and writers never wait on readers (only on other writers).
+    Use update() to write several fields as one change,
+    and snapshot() to read several fields from one version.
+    Use subscribe() to be woken when a field changes or crosses a threshold.
+
+    Args:
+        seed: seed of this instance's random generator, which
+            makes the initial fill and random_fill
+        history: number of writes to keep in a History ring buffer
+            (see history.History). 0 = keep no history
+        values: initial value of any field"""
+
+    move_rnn = DataField(0, doc='Net 1 raw emission')
+
+    affect_rnn = DataField(1, doc='Net 2 raw emission')
+
+    move_affect_conv2 = DataField(2, doc='Net 3 raw emission')
+
+    affect_move_conv2 = DataField(3, doc='Net 4 raw emission')
+
+    master_output = DataField(4, doc='Master output from the affect process. '
+                                     'Setting a list of emissions fills master_vector',
+                              write_size=4)
+
+    master_vector = DataField(4, 4, doc='Full emission list of the master output, '
+                                        'its first value is master_output')
+
+    user_in = DataField(8, doc='Percept input stream from client e.g. live mic level')
+
+    rnd_poetry = DataField(9, doc='Random stream to spice things up')
+
+    affect_net = DataField(10, doc='Output from affect module')
+
+    self_awareness = DataField(11, doc='Net that has some self awareness - ???')
+
+    rhythm_rate = DataField(12, doc='Internal clock/ rhythm sub division')
+
+    # mic percept features (see audio_analysis.FeatureExtractor)
+    rms = DataField(13, doc='Mic level, root mean square 0.0 - 1.0 of full scale')
+
+    centroid = DataField(14, doc='Mic spectral centroid, 0.0 - 1.0 of the Nyquist frequency')
+
+    band_low = DataField(15, doc='Share of mic energy in the low band')
+
+    band_mid = DataField(16, doc='Share of mic energy in the mid band')
+
+    band_high = DataField(17, doc='Share of mic energy in the high band')
+
+    onset = DataField(18, doc='Mic onset strength (spectral flux)')
+
+    tempo = DataField(19, doc='Mic tempo estimate in beats per minute')
+
+    # per channel mic percepts, for ensembles with a mic per performer
+    # NB - channels past the number of mics stay 0.0
+    channel_in = DataField(20, MAX_CHANNELS, doc='Normalised level of each mic channel')
+
+    channel_rms = DataField(20 + MAX_CHANNELS, MAX_CHANNELS, doc='RMS level of each mic channel')
+
+    channel_centroid = DataField(20 + 2 * MAX_CHANNELS, MAX_CHANNELS,
+                                 doc='Spectral centroid of each mic channel')
+
+    channel_onset = DataField(20 + 3 * MAX_CHANNELS, MAX_CHANNELS, doc='Onset strength of each mic channel')
+
+    n_values = 20 + 4 * MAX_CHANNELS
+
+    __slots__ = ('values', '_affect_decision', 'rng', 'history', '_subscriptions', '_version', '_write_lock')
+
+    # numeric fields, in array order
+    field_names = ('move_rnn', 'affect_rnn', 'move_affect_conv2', 'affect_move_conv2',
+                   'master_output', 'user_in', 'rnd_poetry', 'affect_net', 'self_awareness',
+                   'rhythm_rate', 'rms', 'centroid', 'band_low', 'band_mid', 'band_high', 'onset',
+                   'tempo')
+
+    # vector fields
+    vector_names = ('master_vector', 'channel_in', 'channel_rms', 'channel_centroid', 'channel_onset')
+
+    def __init__(self, seed: int = None, history: int = 0, **values):
+        self.rng = np.random.default_rng(seed)
+        self.values = self.rng.random(self.n_values)
+        cls = type(self)
+        self.values[cls.master_vector.slice] = self.values[cls.master_output.offset]
+        self.values[cls.rhythm_rate.offset] = self.rng.integers(30, 100) / 100
+        # the mic percepts are 0.0 until the listener's first write
+        self.values[cls.rms.offset:] = 0
+
+        # current stream chosen by affect process
+        self._affect_decision = " "
+
+        # sequence is odd while a write is in progress
+        self._version = 0
+        self._write_lock = Lock()
+
+        # every write is appended to the history, with the version it made
+        self.history = None
+        if history:
+            columns = {name: getattr(cls, name).slice for name in self.field_names + self.vector_names}
+            self.history = History(columns, self.n_values, history)
+            self.history.append(0, self.values)
+
+        # list of (array index, Subscription)
+        self._subscriptions = []
+
+        if values:
+            self.update(**values)
+
+    def __repr__(self):
+        values = self.snapshot()
+        return f'NebulaDataClass({", ".join(f"{name}={value!r}" for name, value in values.items())})'
+
+    @property
+    def affect_decision(self) -> str:
+        """Current stream chosen by affect process"""
+        return self._affect_decision
+
+    @affect_decision.setter
+    def affect_decision(self, value: str):
+        self.update(affect_decision=value)
+
+    @property
+    def version(self) -> int:
+        """Number of completed updates so far"""
+        return self._version // 2
+
+    @classmethod
+    def field_index(cls, names) -> np.ndarray:
+        """Array index of each named field (the first value of a vector field)"""
+        return np.array([getattr(cls, name).offset for name in names], dtype=np.intp)
+
+    def subscribe(self, name: str, threshold: float = None, rising: bool = True) -> Subscription:
+        """Subscribes to changes of a field (see events.Subscription).
+        Args:
+            name: numeric field to watch
+            threshold: fire when the field crosses this value, None = on every change
+            rising: True = fire on upward crossings, False = downward"""
+        subscription = Subscription(name, threshold, rising)
+        with self._write_lock:
+            self._subscriptions = self._subscriptions + [(getattr(type(self), name).offset, subscription)]
+        return subscription
 
-    move_rnn: float = random()
-    """Net 1 raw emission"""
+    def unsubscribe(self, subscription: Subscription):
+        with self._write_lock:
+            self._subscriptions = [(index, sub) for index, sub in self._subscriptions
+                                   if sub is not subscription]
 
-    affect_rnn: float = random()
-    """Net 2 raw emission"""
+    def update(self, **values):
+        """Writes several fields as one change, readers see all or none of it"""
+        with self._write_lock:
+            old = self.values.copy() if self._subscriptions else None
+            self._version += 1
+            for name, value in values.items():
+                if name == 'affect_decision':
+                    self._affect_decision = value
+                else:
+                    # NB - a scalar fills the whole of a vector field,
+                    # and a shorter list the start of it
+                    target = getattr(type(self), name).write_slice
+                    if target.stop - target.start > 1 and np.ndim(value):
+                        target = slice(target.start, target.start + len(value))
+                    self.values[target] = value
+            self._record()
+            self._version += 1
+            self._notify(old)
 
-    move_affect_conv2: float = random()
-    """Net 3 raw emission"""
+    def update_values(self, values: np.ndarray):
+        """Writes the whole array as one change (e.g. from serialised bytes)"""
+        with self._write_lock:
+            old = self.values.copy() if self._subscriptions else None
+            self._version += 1
+            self.values[:] = values
+            self._record()
+            self._version += 1
+            self._notify(old)
 
-    affect_move_conv2: float = random()
-    """Net 4 raw emission"""
+    def _record(self):
+        # NB - called by writers, inside the write lock
+        if self.history is not None:
+            self.history.append(self._version // 2 + 1, self.values)
 
-    master_output: float = random()
-    """Master output from the affect process"""
+    def _notify(self, old: np.ndarray):
+        # NB - called by writers, inside the write lock, after the write
+        for index, subscription in self._subscriptions:
+            subscription.check(float(old[index]), float(self.values[index]), self._version // 2)
 
-    user_in: float = random()
-    """Percept input stream from client e.g. live mic level"""
+    def random_fill(self):
+        """Fills every numeric Nebula field with a random value from 0.0 to 1.0.
+        NB - the mic percept fields are left alone, the listener owns them"""
+        end = type(self).rms.offset
+        with self._write_lock:
+            old = self.values.copy() if self._subscriptions else None
+            self._version += 1
+            self.values[:end] = self.rng.random(end)
+            self._record()
+            self._version += 1
+            self._notify(old)
 
-    rnd_poetry: float = random()
-    """Random stream to spice things up"""
+    def snapshot_values(self) -> np.ndarray:
+        """Copy of the whole array, all from the same version"""
+        while True:
+            start = self._version
+            if start % 2:
+                # a write is in progress, let the writer finish
+                sleep(0)
+                continue
+            values = self.values.copy()
+            if self._version == start:
+                return values
 
-    affect_net: float = random()
-    """Output from affect module"""
+    def snapshot(self, *names) -> dict:
+        """Reads several fields from the same version.
+        Args:
+            names: fields to read, default is all of them
+        Returns:
+            dict of field name: value"""
+        names = names or self.field_names + self.vector_names + ('affect_decision',)
+        while True:
+            start = self._version
+            if start % 2:
+                sleep(0)
+                continue
+            values = self.values.copy()
+            affect_decision = self._affect_decision
+            if self._version == start:
+                break
 
-    self_awareness: float = random()
-    """Net that has some self awareness - ???"""
+        snapshot = {}
+        for name in names:
+            if name == 'affect_decision':
+                snapshot[name] = affect_decision
+            else:
+                field = getattr(type(self), name)
+                snapshot[name] = float(values[field.offset]) if field.size == 1 else values[field.slice]
+        return snapshot
 
-    affect_decision: str = " "
-    """Current stream chosen by affect process"""
+    def to_bytes(self) -> bytes:
+        """Serialises the numeric fields"""
+        return self.snapshot_values().tobytes()
 
-    rhythm_rate: float = randrange(30, 100) / 100
-    """Internal clock/ rhythm sub division"""
+    def load_bytes(self, data: bytes):
+        """Loads numeric fields serialised by to_bytes"""
+        self.update_values(np.frombuffer(data, dtype=np.float64))
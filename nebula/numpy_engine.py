@@ -0,0 +1,262 @@
+# install python modules
+import json
+import logging
+import numpy as np
+import h5py
+
+# install Nebula modules
+from nebula.backends import Engine
+
+
+class DenseLayer:
+    """Fully connected layer, as keras.layers.Dense"""
+
+    def __init__(self, config: dict, weights: list):
+        self.kernel, self.bias = weights
+        self.activation = ACTIVATIONS[config['activation']]
+        self.buffers = {}
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        out = self.buffers.get(x.shape)
+        if out is None:
+            out = self.buffers[x.shape] = np.empty(x.shape[:-1] + self.bias.shape, dtype=np.float32)
+        np.matmul(x, self.kernel, out=out)
+        out += self.bias
+        return self.activation(out)
+
+
+class LSTMLayer:
+    """Long short-term memory layer, as keras.layers.LSTM
+    (tanh activation, sigmoid recurrent activation,
+    gates in keras order: input, forget, cell, output).
+    Initial states are zero, as the factory nets are not stateful."""
+
+    def __init__(self, config: dict, weights: list):
+        self.kernel, self.recurrent_kernel, self.bias = weights
+        self.units = config['units']
+        self.return_sequences = config['return_sequences']
+        self.go_backwards = config.get('go_backwards', False)
+        self.activation = ACTIVATIONS[config['activation']]
+        self.recurrent_activation = ACTIVATIONS[config['recurrent_activation']]
+        self.buffers = {}
+
+    def get_buffers(self, batch: int, steps: int) -> tuple:
+        # preallocate the working memory once per input shape
+        key = (batch, steps)
+        if key not in self.buffers:
+            self.buffers[key] = (np.empty((batch, 4 * self.units), dtype=np.float32),  # gates
+                                 np.empty((batch, 4 * self.units), dtype=np.float32),  # recurrent gates
+                                 np.empty((batch, self.units), dtype=np.float32),  # cell state
+                                 np.empty((batch, self.units), dtype=np.float32),  # tanh of cell state
+                                 np.empty((batch, steps, self.units), dtype=np.float32))  # hidden states
+        return self.buffers[key]
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        batch, steps = x.shape[:2]
+        z, rz, c, tanh_c, h_seq = self.get_buffers(batch, steps)
+        u = self.units
+        c.fill(0)
+        h = None
+
+        time_order = range(steps - 1, -1, -1) if self.go_backwards else range(steps)
+        for i, t in enumerate(time_order):
+            # gates = x.W + h.U + b
+            np.matmul(x[:, t], self.kernel, out=z)
+            if h is not None:
+                np.matmul(h, self.recurrent_kernel, out=rz)
+                z += rz
+            z += self.bias
+            self.recurrent_activation(z[:, :2 * u])
+            self.activation(z[:, 2 * u:3 * u])
+            self.recurrent_activation(z[:, 3 * u:])
+
+            # c = f * c + i * g;  h = o * tanh(c)
+            c *= z[:, u:2 * u]
+            np.multiply(z[:, :u], z[:, 2 * u:3 * u], out=tanh_c)
+            c += tanh_c
+            np.copyto(tanh_c, c)
+            self.activation(tanh_c)
+            h = h_seq[:, i]
+            np.multiply(z[:, 3 * u:], tanh_c, out=h)
+
+        if self.return_sequences:
+            return h_seq
+        return h
+
+
+class BidirectionalLayer:
+    """Bidirectional wrapper around an LSTM layer, with concat merge mode"""
+
+    def __init__(self, config: dict, weights: list):
+        inner_config = dict(config['layer']['config'])
+        self.forward_layer = LSTMLayer(inner_config, weights[:3])
+        inner_config['go_backwards'] = True
+        self.backward_layer = LSTMLayer(inner_config, weights[3:])
+        self.return_sequences = inner_config['return_sequences']
+        self.buffers = {}
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        forward = self.forward_layer(x)
+        backward = self.backward_layer(x)
+        if self.return_sequences:
+            # backward states are aligned back to the forward timeline
+            backward = backward[:, ::-1]
+        out = self.buffers.get(forward.shape)
+        if out is None:
+            out = self.buffers[forward.shape] = np.empty(forward.shape[:-1] + (2 * forward.shape[-1],),
+                                                         dtype=np.float32)
+        np.concatenate((forward, backward), axis=-1, out=out)
+        return out
+
+
+class DropoutLayer:
+    """Dropout is only used in training, so does nothing at inference"""
+
+    def __init__(self, config: dict, weights: list):
+        pass
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        return x
+
+
+def sigmoid(x: np.ndarray) -> np.ndarray:
+    """In-place logistic sigmoid"""
+    np.negative(x, out=x)
+    np.exp(x, out=x)
+    x += 1
+    np.reciprocal(x, out=x)
+    return x
+
+
+def tanh(x: np.ndarray) -> np.ndarray:
+    """In-place hyperbolic tangent"""
+    return np.tanh(x, out=x)
+
+
+def linear(x: np.ndarray) -> np.ndarray:
+    return x
+
+
+ACTIVATIONS = {'sigmoid': sigmoid,
+               'tanh': tanh,
+               'linear': linear}
+
+LAYERS = {'Dense': DenseLayer,
+          'LSTM': LSTMLayer,
+          'Bidirectional': BidirectionalLayer,
+          'Dropout': DropoutLayer}
+
+
+def load_h5_weights(path: str) -> tuple:
+    """Reads the layer configs and weights out of a keras .h5 model file.
+    Returns:
+        (list of layer configs, dict of layer name: list of weight arrays)"""
+    with h5py.File(path, 'r') as h5_file:
+        model_config = h5_file.attrs['model_config']
+        if isinstance(model_config, bytes):
+            model_config = model_config.decode('utf-8')
+        layer_configs = json.loads(model_config)['config']['layers']
+
+        weights = {}
+        model_weights = h5_file['model_weights']
+        for layer_config in layer_configs:
+            name = layer_config['config']['name']
+            group = model_weights[name]
+            weights[name] = [np.array(group[weight_name], dtype=np.float32)
+                             for weight_name in group.attrs['weight_names']]
+    return layer_configs, weights
+
+
+class NumpyNet:
+    """Runs the forward pass of a keras Sequential net in plain NumPy.
+    Weights are read once from the .h5 file, and all working memory is
+    preallocated per input shape, so a prediction never touches TensorFlow.
+
+    Args:
+        path: path to the keras .h5 model file
+        weights: optional (layer configs, weights) already read from the file"""
+
+    def __init__(self, path: str, weights: tuple = None):
+        self.path = path
+        layer_configs, weights = weights or load_h5_weights(path)
+        self.layers = []
+        for layer_config in layer_configs:
+            class_name = layer_config['class_name']
+            if class_name not in LAYERS:
+                raise NotImplementedError(f'{class_name} layer not supported by the numpy engine ({path})')
+            config = layer_config['config']
+            self.layers.append(LAYERS[class_name](config, weights[config['name']]))
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        """Args:
+            x: array of shape (batch, timesteps, features)
+        Returns:
+            array of shape (batch, outputs). NB this is a reused buffer"""
+        x = np.asarray(x, dtype=np.float32)
+        for layer in self.layers:
+            x = layer(x)
+        return x
+
+    def predict(self, x, verbose=0) -> np.ndarray:
+        """Keras style prediction, returns a new array"""
+        return self(x).copy()
+
+
+class NumpyEngine(Engine):
+    """Runs the nets of the AI Factory in plain NumPy.
+
+    Args:
+        nets: list of NumpyNet, one per slot on the patch board"""
+
+    name = 'numpy'
+
+    def __init__(self, nets: list):
+        super().__init__(nets)
+        self.preds = np.zeros((len(nets), 4), dtype=np.float32)
+
+    def predict(self, in_vals: np.ndarray, slots: np.ndarray = None) -> np.ndarray:
+        for net, group_slots, batch in self.group_inputs(in_vals, slots):
+            self.preds[group_slots] = net(batch)
+        return self.preds.copy()
+
+
+# most the numpy nets may differ from keras by, float32 rounding only
+PARITY_TOLERANCE = 1e-5
+
+
+def parity_check(path: str, n_inputs: int = 100, tolerance: float = PARITY_TOLERANCE,
+                 numpy_net: NumpyNet = None, keras_net=None) -> float:
+    """Drives the keras model and the numpy net with the same inputs
+    and returns the maximum absolute difference of their outputs.
+    Args:
+        numpy_net: the net to check, default loads one from path
+        keras_net: the keras model of path, default loads it
+    Raises:
+        ValueError if the outputs differ by more than tolerance"""
+    if keras_net is None:
+        import tensorflow as tf
+        keras_net = tf.keras.models.load_model(path, compile=False)
+    numpy_net = numpy_net or NumpyNet(path)
+
+    # single scalar inputs as used by the factory, plus a short sequence
+    in_vals = np.random.uniform(-0.5, 1.5, (n_inputs, 1, 1)).astype(np.float32)
+    sequence = np.random.uniform(0, 1, (2, 5, 1)).astype(np.float32)
+
+    max_error = 0
+    for x in (in_vals, sequence):
+        keras_out = keras_net.predict(x, verbose=0)
+        numpy_out = numpy_net.predict(x)
+        max_error = max(max_error, float(np.max(np.abs(keras_out - numpy_out))))
+    if max_error > tolerance:
+        raise ValueError(f'numpy net of {path} differs from keras by {max_error:.2e} '
+                         f'(tolerance {tolerance:.0e})')
+    return max_error
+
+
+if __name__ == "__main__":
+    import glob
+
+    logging.basicConfig(level=logging.INFO)
+    # NB - raises on the first net that drifts
+    for model_path in sorted(glob.glob('nebula/models/*.h5')):
+        print(f'OK: {model_path} max abs error vs keras = {parity_check(model_path)}')
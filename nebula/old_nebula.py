@@ -25,6 +25,9 @@ import numpy as np
 from random import random, getrandbits
 from time import sleep
 
+# install Nebula modules
+from nebula.model_registry import registry
+
 
 class NebulaDataEngine():
     """An AI engine that generates gestural thought trains.
@@ -78,15 +81,15 @@ class NebulaDataEngine():
 
         # instantiate nets as objects and make  models
         print('MoveRNN initialization')
-        self.move_net = tf.keras.models.load_model('nebula/models/EMR-full-sept-2021_RNN_skeleton_data.nose.x.h5')
+        self.move_net = registry.load('nebula/models/EMR-full-sept-2021_RNN_skeleton_data.nose.x.h5')
         print('AffectRNN initialization')
-        self.affect_net = tf.keras.models.load_model('nebula/models/EMR-full-sept-2021_RNN_bitalino.h5')
+        self.affect_net = registry.load('nebula/models/EMR-full-sept-2021_RNN_bitalino.h5')
         print('MoveAffectCONV2 initialization')
-        self.move_affect_net = tf.keras.models.load_model('nebula/models/EMR-full-sept-2021_conv2D_move-affect.h5')
+        self.move_affect_net = registry.load('nebula/models/EMR-full-sept-2021_conv2D_move-affect.h5')
         print('AffectMoveCONV2 initialization')
-        self.affect_move_net = tf.keras.models.load_model('nebula/models/EMR-full-sept-2021_conv2D_affect-move.h5')
+        self.affect_move_net = registry.load('nebula/models/EMR-full-sept-2021_conv2D_affect-move.h5')
         print('MoveAffectCONV2 initialization')
-        self.affect_perception = tf.keras.models.load_model('nebula/models/EMR-full-sept-2021_conv2D_move-affect.h5')
+        self.affect_perception = registry.load('nebula/models/EMR-full-sept-2021_conv2D_move-affect.h5')
 
         # logging on/off switches
         self.net_logging = False
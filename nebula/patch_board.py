@@ -0,0 +1,119 @@
+# install python modules
+import logging
+from dataclasses import dataclass
+import numpy as np
+
+
+@dataclass
+class Net:
+    """Declares one net on the AI Factory patch board"""
+
+    name: str
+    """Name of the net"""
+
+    model: str
+    """Path to the model file of the net"""
+
+    input: str
+    """Datadict field plugged into the net"""
+
+    output: str
+    """Datadict field that gets one of the net's emissions each tick"""
+
+
+# the EMR factory, as first hand-coded in make_data
+EMR_FACTORY = [Net('move_rnn',
+                   'nebula/models/EMR-full-sept-2021_RNN_skeleton_data.nose.x.h5',
+                   input='move_rnn', output='move_rnn'),
+               Net('affect_rnn',
+                   'nebula/models/EMR-full-sept-2021_RNN_bitalino.h5',
+                   input='affect_rnn', output='affect_rnn'),
+               Net('move_affect_conv2',
+                   'nebula/models/EMR-full-sept-2021_conv2D_move-affect.h5',
+                   input='move_affect_conv2', output='move_affect_conv2'),
+               Net('affect_move_conv2',
+                   'nebula/models/EMR-full-sept-2021_conv2D_affect-move.h5',
+                   input='affect_rnn', output='affect_move_conv2'),
+               Net('self_awareness',
+                   'nebula/models/EMR-full-sept-2021_conv2D_move-affect.h5',
+                   input='master_output', output='self_awareness')]
+
+
+class PatchBoard:
+    """Declarative wiring of the nets in an AI Factory.
+    Every net reads its input field at the start of a tick and puts one
+    of its emissions into its output field. The full emission list of
+    the last net goes to the master field.
+
+    Args:
+        nets: list of Net declarations
+        master: datadict field that gets the last net's full emission list"""
+
+    def __init__(self, nets: list = None, master: str = 'master_output'):
+        self.nets = nets or EMR_FACTORY
+        self.master = master
+
+    def compile(self) -> 'ExecutionPlan':
+        """Compiles the wiring into index arrays over a state vector of fields.
+        The state vector holds each net's output field in board order,
+        then the master field, then any other fields plugged into a net."""
+        fields = [net.output for net in self.nets]
+        if len(set(fields)) != len(fields):
+            raise ValueError(f'two nets on the patch board share an output field: {fields}')
+        fields.append(self.master)
+        for net in self.nets:
+            if net.input not in fields:
+                fields.append(net.input)
+
+        return ExecutionPlan(fields=fields,
+                             net_names=[net.name for net in self.nets],
+                             model_paths=[net.model for net in self.nets],
+                             input_index=np.array([fields.index(net.input) for net in self.nets],
+                                                  dtype=np.int32))
+
+
+class ExecutionPlan:
+    """A compiled patch board.
+    All nets read the state at the start of the tick, so none depend on
+    another within a tick, and the whole board goes to the engine as one
+    batch. Nets are only re-evaluated if their input has changed since
+    they were last run; otherwise their last emissions are reused.
+
+    Args:
+        fields: datadict field of each entry of the state vector
+        net_names: name of each net
+        model_paths: model file of each net
+        input_index: index into the state vector of each net's input"""
+
+    def __init__(self, fields: list, net_names: list, model_paths: list, input_index: np.ndarray):
+        self.fields = fields
+        self.net_names = net_names
+        self.model_paths = model_paths
+        self.input_index = input_index
+        self.n_nets = len(net_names)
+        self.master = fields[self.n_nets]
+
+        self.last_in_vals = np.full(self.n_nets, np.nan, dtype=np.float32)
+        self.last_preds = np.zeros((self.n_nets, 4), dtype=np.float32)
+        self.evaluations = 0
+        self.reuses = 0
+
+    def run(self, engine, in_vals: np.ndarray) -> np.ndarray:
+        """Predicts the whole board, only re-evaluating nets whose input changed.
+        Args:
+            engine: the AI Factory engine
+            in_vals: array of shape (n_nets,) of the input of each net
+        Returns:
+            array of shape (n_nets, 4) of the emissions of each net"""
+        changed = in_vals != self.last_in_vals
+        n_changed = int(np.count_nonzero(changed))
+        self.evaluations += n_changed
+        self.reuses += self.n_nets - n_changed
+
+        if n_changed:
+            preds = engine.predict(in_vals, changed)
+            self.last_preds[changed] = preds[changed]
+            self.last_in_vals[changed] = in_vals[changed]
+        else:
+            logging.debug('patch board inputs unchanged, reusing last emissions')
+        return self.last_preds.copy()
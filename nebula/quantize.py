@@ -0,0 +1,184 @@
+"""
+Reduced precision (float16 and int8) variants of the AI Factory nets.
+Each keras .h5 model is converted to a TensorFlow Lite model with either
+float16 weights, or full integer int8 quantization: int8 weights and
+activations (int16 LSTM cell states), with the activation ranges
+calibrated on representative inputs across Nebula's 0.0 - 1.0 range.
+Only the model input and output stay float, so the nets are drop in.
+The converted models are kept in the model registry cache, keyed by the
+content hash of the original.
+
+Run this module to convert all the models in nebula/models and report
+output drift and per-tick latency against the float32 originals:
+    python -m nebula.quantize
+"""
+# install python modules
+import os
+import logging
+from time import perf_counter
+import numpy as np
+
+# install Nebula modules
+from nebula.numpy_engine import NumpyEngine
+
+PRECISIONS = ('float16', 'int8')
+
+# registry cache file of each precision
+# NB - int8 was once dynamic range quantized, so it has a new name
+CACHE_SUFFIXES = {'float16': 'float16.tflite', 'int8': 'int8-full.tflite'}
+
+
+def representative_inputs(n_sequences: int = 20, length: int = 50, seed: int = 0):
+    """Inputs to calibrate the int8 activation ranges with, like the
+    factory's: a sweep across 0.0 - 1.0, then random walks across it"""
+    rng = np.random.default_rng(seed)
+    for in_val in np.linspace(0, 1, 101):
+        yield [np.full((1, 1, 1), in_val, dtype=np.float32)]
+    steps = rng.normal(0, 0.1, (n_sequences, length))
+    sequences = np.clip(np.cumsum(steps, axis=1) + rng.uniform(0, 1, (n_sequences, 1)), 0, 1)
+    for in_val in sequences.ravel():
+        yield [np.full((1, 1, 1), in_val, dtype=np.float32)]
+
+
+def quantize_model(path: str, precision: str, out_path: str) -> str:
+    """Converts a keras .h5 model to a reduced precision TFLite model.
+    Args:
+        path: path to the keras .h5 model file
+        precision: 'float16' or 'int8'
+        out_path: where to save the .tflite model
+    Returns:
+        out_path"""
+    import tensorflow as tf
+
+    if precision not in PRECISIONS:
+        raise ValueError(f'unknown precision: {precision}')
+
+    # the factory always feeds a single (1, 1, 1) value
+    model = tf.keras.models.load_model(path, compile=False)
+    graph = tf.function(lambda x: model(x, training=False),
+                        input_signature=[tf.TensorSpec((1, 1, 1), tf.float32)])
+
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([graph.get_concrete_function()], model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if precision == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    else:
+        # full integer: every op int8, or the conversion fails
+        converter.representative_dataset = representative_inputs
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    tflite_model = converter.convert()
+
+    os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+    with open(out_path, 'wb') as tflite_file:
+        tflite_file.write(tflite_model)
+    print(f'quantized {path} to {precision}: {out_path} ({len(tflite_model)} bytes)')
+    return out_path
+
+
+class TFLiteNet:
+    """Runs a .tflite net, with the tflite_runtime interpreter if it is
+    installed, so TensorFlow is not needed at runtime.
+
+    Args:
+        path: path to the .tflite model file"""
+
+    def __init__(self, path: str):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+
+        self.path = path
+        self.interpreter = Interpreter(model_path=path)
+        self.interpreter.allocate_tensors()
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+
+    def __call__(self, x: np.ndarray) -> np.ndarray:
+        """Args:
+            x: array of shape (1, 1, 1)
+        Returns:
+            array of shape (1, 4)"""
+        # TFLite keeps LSTM states between invokes, but the keras nets are
+        # not stateful, so start every prediction from zero states
+        self.interpreter.reset_all_variables()
+        self.interpreter.set_tensor(self.input_index, x)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output_index)
+
+    def predict(self, x, verbose=0) -> np.ndarray:
+        """Keras style prediction, one invoke per row of the batch"""
+        x = np.asarray(x, dtype=np.float32)
+        return np.concatenate([self(x[i:i + 1]) for i in range(len(x))])
+
+
+class TFLiteEngine(NumpyEngine):
+    """Runs the reduced precision nets of the AI Factory.
+
+    Args:
+        nets: list of TFLiteNet, one per slot on the patch board"""
+
+    name = 'tflite'
+
+    def predict(self, in_vals: np.ndarray, slots: np.ndarray = None) -> np.ndarray:
+        # the TFLite nets take a fixed (1, 1, 1) input, so one invoke per net
+        for net, group_slots, batch in self.group_inputs(in_vals, slots):
+            for slot, in_val in zip(group_slots, batch):
+                self.preds[slot] = net(in_val[np.newaxis])[0]
+        return self.preds.copy()
+
+
+def drift_report(path: str, precision: str, quantized_path: str,
+                 n_sequences: int = 10, length: int = 100) -> dict:
+    """Drives the float32 net and its reduced precision variant with the
+    same input sequences (random walks across 0.0 - 1.0, one value per tick),
+    and measures output drift and per-tick latency of both.
+    Returns:
+        dict of the drift and latency stats"""
+    from nebula.numpy_engine import NumpyNet
+
+    reference = NumpyNet(path)
+    quantized = TFLiteNet(quantized_path)
+
+    steps = np.random.normal(0, 0.1, (n_sequences, length))
+    sequences = np.clip(np.cumsum(steps, axis=1) + np.random.uniform(0, 1, (n_sequences, 1)), 0, 1)
+
+    errors = []
+    reference_times = []
+    quantized_times = []
+    x = np.zeros((1, 1, 1), dtype=np.float32)
+    for in_val in sequences.ravel():
+        x[0, 0, 0] = in_val
+
+        start = perf_counter()
+        reference_out = reference(x).copy()
+        reference_times.append(perf_counter() - start)
+
+        start = perf_counter()
+        quantized_out = quantized(x)
+        quantized_times.append(perf_counter() - start)
+
+        errors.append(np.abs(reference_out - quantized_out).max())
+
+    errors = np.array(errors)
+    return {'model': os.path.basename(path),
+            'precision': precision,
+            'max_drift': float(errors.max()),
+            'mean_drift': float(errors.mean()),
+            'float32_tick_ms': 1000 * float(np.mean(reference_times)),
+            'quantized_tick_ms': 1000 * float(np.mean(quantized_times)),
+            'quantized_p95_tick_ms': 1000 * float(np.percentile(quantized_times, 95))}
+
+
+if __name__ == "__main__":
+    import glob
+    from nebula.model_registry import registry
+
+    logging.basicConfig(level=logging.INFO)
+    for model_path in sorted(glob.glob('nebula/models/*.h5')):
+        for model_precision in PRECISIONS:
+            registry.load(model_path, model_precision)
+            report = drift_report(model_path, model_precision,
+                                  registry.cache_path(model_path, CACHE_SUFFIXES[model_precision]))
+            print(report)
@@ -0,0 +1,131 @@
+# install python modules
+import logging
+from time import monotonic, sleep
+
+
+class Scheduler:
+    """Monotonic clock scheduler for the rhythm of a loop.
+    Each wait sleeps until an absolute deadline, one period after the
+    last beat, so the time spent working in the loop is taken out of
+    the sleep rather than added to the period. Nested cycles end on
+    absolute deadlines counted from the beat as well.
+
+    If the work overruns by a whole period the missed beats are dropped,
+    and the beat re-anchors to now, rather than rushing to catch up.
+
+    A wait can also be woken early by a threading Event (e.g. a datadict
+    Subscription firing). The beat is not moved by an early wake.
+
+    Example:
+        scheduler = Scheduler('drawbot')
+        cycle_end = scheduler.deadline(4)
+        while not scheduler.expired(cycle_end):
+            do_work()
+            scheduler.wait(rhythm_rate)
+
+    Args:
+        name: name of the loop for the stats report
+        clock: monotonic clock in seconds"""
+
+    def __init__(self, name: str = 'scheduler', clock=monotonic):
+        self.name = name
+        self.clock = clock
+        self.beat = None
+
+        # stats
+        self.beats = 0
+        self.wakeups = 0
+        self.overruns = 0
+        self.dropped = 0
+        self.total_jitter = 0.0
+        self.max_jitter = 0.0
+        self.max_overrun = 0.0
+
+    def start(self) -> 'Scheduler':
+        """(Re)anchors the beat to now, e.g. after blocking work outside the rhythm"""
+        self.beat = self.clock()
+        return self
+
+    def deadline(self, duration: float) -> float:
+        """Absolute clock time duration seconds after the current beat"""
+        if self.beat is None:
+            self.start()
+        return self.beat + duration
+
+    def expired(self, deadline: float) -> bool:
+        return self.clock() >= deadline
+
+    def remaining(self, deadline: float) -> float:
+        """Seconds until deadline, 0 if it has passed"""
+        return max(0.0, deadline - self.clock())
+
+    def wait(self, period: float, wake=None) -> float:
+        """Sleeps until the next beat, period seconds after the last one.
+        Args:
+            period: seconds between beats
+            wake: optional threading Event (or anything with wait(timeout)
+                returning True when set) that ends the wait early
+        Returns:
+            how late the beat fired in seconds, negative if woken early"""
+        if self.beat is None:
+            self.start()
+        target = self.beat + period
+        delay = target - self.clock()
+        if delay > 0:
+            if wake is not None:
+                if wake.wait(delay):
+                    self.wakeups += 1
+                    return self.clock() - target
+            else:
+                sleep(delay)
+        woke = self.clock()
+        late = woke - target
+
+        self.beats += 1
+        if delay <= 0:
+            self.overruns += 1
+            self.max_overrun = max(self.max_overrun, -delay)
+        else:
+            self.total_jitter += late
+            self.max_jitter = max(self.max_jitter, late)
+
+        # drop missed beats rather than firing them all at once
+        if late >= period:
+            self.dropped += int(late // period) if period > 0 else 1
+            self.beat = woke
+        else:
+            self.beat = target
+        return late
+
+    def stats(self) -> dict:
+        """Jitter (lateness of a beat after a sleep) and overrun (beats where
+        the work took longer than the period) stats, in seconds"""
+        on_time = self.beats - self.overruns
+        return {'beats': self.beats,
+                'wakeups': self.wakeups,
+                'overruns': self.overruns,
+                'dropped_beats': self.dropped,
+                'mean_jitter': self.total_jitter / on_time if on_time else 0.0,
+                'max_jitter': self.max_jitter,
+                'max_overrun': self.max_overrun}
+
+    def report(self):
+        stats = self.stats()
+        logging.info(f'{self.name} scheduler: {stats["beats"]} beats, {stats["wakeups"]} early wakeups, '
+                     f'{stats["overruns"]} overruns (max {1000 * stats["max_overrun"]:.1f} ms), '
+                     f'{stats["dropped_beats"]} dropped, '
+                     f'jitter mean {1000 * stats["mean_jitter"]:.2f} ms max {1000 * stats["max_jitter"]:.2f} ms')
+
+
+if __name__ == "__main__":
+    from random import uniform
+
+    logging.basicConfig(level=logging.INFO)
+    # 20 beats of 0.1 seconds, with up to 0.08 seconds of work each
+    test = Scheduler('test').start()
+    start = test.beat
+    for _ in range(20):
+        sleep(uniform(0, 0.08))
+        test.wait(0.1)
+    print(f'20 beats of 0.1 seconds took {test.clock() - start:.3f} seconds')
+    test.report()
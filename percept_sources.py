@@ -0,0 +1,261 @@
+"""
+Percept sources other than the live mic, for offline and load runs.
+Every source reads int16 blocks of shape (frames, channels) like
+audio_capture.AudioCapture (which is the live source), so they all
+go through the same audio_analysis.PerceptStage into the datadict.
+
+Run this module to push a synthetic performance (or a WAV file) through
+the percept stage as fast as possible, and report the throughput:
+    python percept_sources.py [file.wav]
+"""
+import sys
+import wave
+import logging
+from dataclasses import dataclass
+from time import perf_counter, sleep
+import numpy as np
+
+# install Nebula modules
+from nebula.scheduler import Scheduler
+
+
+class PacedSource:
+    """Base of the offline sources: paces reads at real time, a multiple
+    of it, or as fast as possible.
+
+    Args:
+        rate: sample rate in Hz
+        chunk: frames per block
+        channels: channels per frame
+        speed: 1 = real time, 4 = four times real time, None = no pacing"""
+
+    def __init__(self, rate: int, chunk: int, channels: int, speed: float = 1):
+        self.rate = rate
+        self.chunk = chunk
+        self.channels = channels
+        self.speed = speed
+        self.scheduler = Scheduler('percept source')
+        self.frames_read = 0
+        self.finished = False
+        self.dropped_frames = 0
+
+    def open(self):
+        pass
+
+    def start(self):
+        self.scheduler.start()
+
+    def read(self, out: np.ndarray, timeout: float = 1.0) -> bool:
+        """Fills out (frames, channels) with the next block, at the source's pace.
+        Returns:
+            False once the source has finished"""
+        if self.finished:
+            # like a live device with no input, wait out the timeout,
+            # even when unpaced, so a listener polling it does not spin
+            sleep(timeout)
+            return False
+        if self.speed:
+            self.scheduler.wait(len(out) / self.rate / self.speed)
+        if not self.fill(out):
+            self.finished = True
+            return False
+        self.frames_read += len(out)
+        return True
+
+    def fill(self, out: np.ndarray) -> bool:
+        raise NotImplementedError
+
+    def stop(self):
+        logging.info(f'{type(self).__name__}: {self.frames_read / self.rate:.1f} seconds of percepts read')
+
+
+class FileSource(PacedSource):
+    """Streams a 16 bit WAV file, or a raw interleaved int16 file,
+    through a memory map, so the file is never loaded whole.
+
+    Args:
+        path: .wav file, or raw int16 file
+        chunk: frames per block
+        speed: 1 = real time, 4 = four times real time, None = no pacing
+        loop: start again at the end rather than finishing
+        rate: sample rate of a raw file (WAV files have their own)
+        channels: channels of a raw file (WAV files have their own)"""
+
+    def __init__(self, path: str, chunk: int = 2 ** 11, speed: float = 1, loop: bool = False,
+                 rate: int = 44100, channels: int = 1):
+        offset = 0
+        if path.lower().endswith('.wav'):
+            with open(path, 'rb') as wav_file:
+                wav = wave.open(wav_file)
+                if wav.getsampwidth() != 2:
+                    raise ValueError(f'{path} is not 16 bit audio')
+                rate = wav.getframerate()
+                channels = wav.getnchannels()
+                n_frames = wav.getnframes()
+                # NB - after reading the header the file is at the start of the data
+                offset = wav_file.tell()
+        else:
+            n_frames = None
+
+        super().__init__(rate, chunk, channels, speed)
+        self.path = path
+        self.loop = loop
+        self.samples = np.memmap(path, dtype='<i2', mode='r', offset=offset)
+        if n_frames is None:
+            n_frames = len(self.samples) // channels
+        self.samples = self.samples[:n_frames * channels].reshape(n_frames, channels)
+        self.position = 0
+
+    def fill(self, out: np.ndarray) -> bool:
+        n = len(out)
+        if self.position + n > len(self.samples):
+            if not self.loop or n > len(self.samples):
+                return False
+            self.position = 0
+        out[:] = self.samples[self.position:self.position + n]
+        self.position += n
+        return True
+
+
+@dataclass
+class Section:
+    """One section of a synthetic performance"""
+
+    kind: str
+    """'silence', 'steady', 'crescendo' (level to end_level) or 'bursts'"""
+
+    seconds: float
+    """Length of the section"""
+
+    level: float = 0.0
+    """Noise level, 0.0 - 1.0 of full scale (start level of a crescendo,
+    level between bursts)"""
+
+    end_level: float = 0.0
+    """End level of a crescendo, level of the bursts"""
+
+    burst_every: float = 0.5
+    """Seconds between the starts of bursts"""
+
+    burst_length: float = 0.05
+    """Seconds each burst lasts"""
+
+
+# a short scripted performance with all the dynamics
+DEMO_SCRIPT = [Section('silence', 2),
+               Section('crescendo', 8, level=0.005, end_level=0.4),
+               Section('steady', 4, level=0.1),
+               Section('bursts', 8, level=0.01, end_level=0.9, burst_every=0.5),
+               Section('silence', 2)]
+
+
+class SyntheticSource(PacedSource):
+    """Generates a scripted performance of noise with dynamics:
+    silence, steady levels, crescendos and bursts.
+
+    Args:
+        script: list of Section, played in order
+        rate: sample rate in Hz
+        chunk: frames per block
+        channels: channels per frame, each with its own noise
+        speed: 1 = real time, 4 = four times real time, None = no pacing
+        loop: start the script again at the end rather than finishing
+        seed: seed of the noise generator"""
+
+    def __init__(self, script: list = None, rate: int = 44100, chunk: int = 2 ** 11,
+                 channels: int = 1, speed: float = 1, loop: bool = False, seed: int = None):
+        super().__init__(rate, chunk, channels, speed)
+        self.script = script or DEMO_SCRIPT
+        self.loop = loop
+        self.rng = np.random.default_rng(seed)
+
+        # frame at which each section starts
+        self.starts = np.cumsum([0] + [int(section.seconds * rate) for section in self.script])
+        self.position = 0
+
+        # preallocated block buffers
+        self.noise = np.zeros((chunk, channels), dtype=np.float32)
+        self.envelope = np.zeros((chunk, 1), dtype=np.float32)
+        self.frames = np.arange(chunk, dtype=np.float64)[:, np.newaxis]
+
+    def fill(self, out: np.ndarray) -> bool:
+        n = len(out)
+        if self.position + n > self.starts[-1]:
+            if not self.loop:
+                return False
+            self.position = 0
+
+        # envelope of the block, section by section
+        frames = self.frames[:n] + self.position
+        envelope = self.envelope[:n]
+        for section, start, end in zip(self.script, self.starts[:-1], self.starts[1:]):
+            if end <= self.position or start >= self.position + n:
+                continue
+            inside = (frames >= start) & (frames < end)
+            envelope[inside] = self.section_level(section, (frames[inside] - start) / self.rate)
+
+        self.rng.standard_normal(dtype=np.float32, out=self.noise[:n])
+        self.noise[:n] *= envelope
+        self.noise[:n] *= 32767
+        np.clip(self.noise[:n], -32768, 32767, out=self.noise[:n])
+        out[:] = self.noise[:n]
+        self.position += n
+        return True
+
+    @staticmethod
+    def section_level(section: Section, seconds: np.ndarray) -> np.ndarray:
+        """Noise level through a section, at seconds from its start"""
+        if section.kind == 'silence':
+            return np.zeros_like(seconds)
+        if section.kind == 'steady':
+            return np.full_like(seconds, section.level)
+        if section.kind == 'crescendo':
+            return section.level + (section.end_level - section.level) * seconds / section.seconds
+        if section.kind == 'bursts':
+            in_burst = (seconds % section.burst_every) < section.burst_length
+            return np.where(in_burst, section.end_level, section.level)
+        raise ValueError(f'unknown section kind: {section.kind}')
+
+
+def run_percepts(source, datadict, calibration_path: str = None, max_chunks: int = None) -> dict:
+    """Pushes a source through the percept stage into the datadict,
+    like Main.listener, until the source finishes.
+    Returns:
+        dict of throughput stats"""
+    from audio_analysis import PerceptStage
+
+    percept = PerceptStage(datadict,
+                           rate=source.rate,
+                           chunk=source.chunk,
+                           channels=source.channels,
+                           calibration_path=calibration_path)
+    source.start()
+    chunks = 0
+    start = perf_counter()
+    while max_chunks is None or chunks < max_chunks:
+        if not source.read(percept.block):
+            break
+        percept.process()
+        chunks += 1
+    elapsed = perf_counter() - start
+    source.stop()
+
+    audio_seconds = chunks * source.chunk / source.rate
+    return {'chunks': chunks,
+            'audio_seconds': audio_seconds,
+            'elapsed_seconds': elapsed,
+            'times_real_time': audio_seconds / elapsed if elapsed else float('inf'),
+            'ms_per_chunk': 1000 * elapsed / chunks if chunks else 0.0}
+
+
+if __name__ == "__main__":
+    from nebula.nebula_dataclass import NebulaDataClass
+
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) > 1:
+        test_source = FileSource(sys.argv[1], speed=None)
+    else:
+        test_source = SyntheticSource(speed=None, seed=0)
+    test_datadict = NebulaDataClass(history=2 ** 12)
+    print(run_percepts(test_source, test_datadict))
+    print(test_datadict)
@@ -0,0 +1,94 @@
+from time import perf_counter
+from threading import Thread
+import logging
+
+
+class Startup:
+    """Runs the startup phases of a piece (e.g. AI factory warm up,
+    audio stream, robot homing and stave drawing) in parallel threads,
+    so the time between pieces is the longest phase, not their sum.
+    Each phase is timed and reported. If any phase fails, the others
+    still finish, then the ones that succeeded are cleaned up (e.g. the
+    robot transport and mic streams stopped) and the failure is raised.
+
+    Example:
+        startup = Startup()
+        startup.add_phase('nebula', build_nebula)
+        startup.add_phase('robot', build_digibot, port, cleanup=close_digibot)
+        results = startup.run()
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.results = {}
+        self.errors = {}
+        self.timings = {}
+        self.cleanups = {}
+
+    def add_phase(self, name: str, func, *args, cleanup=None, **kwargs):
+        """Adds a phase to be run in its own thread.
+        Args:
+            name: name of the phase for the report
+            func: callable running the phase, its return value is kept in results
+            cleanup: optional callable that stops whatever the phase started,
+                called if another phase fails"""
+        self.phases[name] = (func, args, kwargs)
+        if cleanup is not None:
+            self.cleanups[name] = cleanup
+
+    def run_phase(self, name: str):
+        func, args, kwargs = self.phases[name]
+        start = perf_counter()
+        try:
+            self.results[name] = func(*args, **kwargs)
+        except Exception as error:
+            logging.exception(f'startup phase {name} failed')
+            self.errors[name] = error
+        finally:
+            self.timings[name] = perf_counter() - start
+            logging.info(f'startup phase {name} finished in {self.timings[name]:.2f} seconds')
+
+    def run(self) -> dict:
+        """Runs all phases in parallel and waits for them all to finish.
+        Returns:
+            dict of phase name: result of that phase"""
+        start = perf_counter()
+        threads = [Thread(target=self.run_phase, args=(name,), name=f'startup-{name}')
+                   for name in self.phases]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.timings['total'] = perf_counter() - start
+        self.report()
+
+        if self.errors:
+            self.clean_up()
+            name, error = next(iter(self.errors.items()))
+            raise RuntimeError(f'startup phase {name} failed') from error
+        return self.results
+
+    def clean_up(self):
+        """Stops whatever the phases that succeeded started"""
+        for name in self.results:
+            if name in self.cleanups:
+                try:
+                    self.cleanups[name]()
+                    logging.info(f'startup phase {name} cleaned up')
+                except Exception:
+                    logging.exception(f'startup phase {name} cleanup failed')
+
+    def report(self):
+        """Prints how long each phase took, against running them in sequence"""
+        sequential = sum(duration for name, duration in self.timings.items() if name != 'total')
+        print('startup report:')
+        for name, duration in self.timings.items():
+            if name != 'total':
+                print(f'\t{name}: {duration:.2f} seconds')
+        print(f'\ttotal: {self.timings["total"]:.2f} seconds '
+              f'(in sequence would be {sequential:.2f} seconds)')
+
+
+def non_interactive_prompt(message: str):
+    """Pen prompt hook for unattended starts, logs the prompt and carries on"""
+    logging.info(f'non-interactive start, skipping prompt: {message}')